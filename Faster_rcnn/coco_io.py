@@ -0,0 +1,130 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+# one record per scan: byte ranges of its image and annotation entries inside the COCO JSON
+INDEX_FIELDS = [
+    ("img_start", "i8"), ("img_end", "i8"),
+    ("ann_start", "i8"), ("ann_end", "i8"),
+    ("first_image_id", "i8"), ("num_images", "i8"), ("num_annotations", "i8"),
+]
+
+def index_dtype(scan_ids):
+    # the scan_id field is sized to the longest id so no id is truncated
+    return np.dtype([("scan_id", f"U{max((len(i) for i in scan_ids), default=1) or 1}")] + INDEX_FIELDS)
+
+def coco_index_path(json_path):
+    return os.path.splitext(json_path)[0] + "_index.npy"
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+class CocoStreamWriter:
+    """
+    Writes a COCO JSON scan by scan in compact form, without holding the whole dataset in memory.
+
+    Images are written straight to the output file, annotations are staged in a temporary file
+    and appended when the writer is closed. The output only replaces json_path once it is complete.
+    If index_path is given, a structured .npy index (see index_dtype) with the byte ranges of every
+    scan is saved as well, so readers can seek to single scans with load_coco_scans.
+    """
+    def __init__(self, json_path, categories, index_path=None):
+        self.json_path = json_path
+        self.categories = categories
+        self.index_path = index_path
+        self.records = []
+        self.num_images = 0
+        self.num_annotations = 0
+        self._tmp_path = json_path + ".tmp"
+        self._out = open(self._tmp_path, "wb")
+        self._anns = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(json_path)))
+        self._out.write(b'{"images":[')
+
+    @staticmethod
+    def _write_items(f, items, first):
+        # returns the [start, end) byte range of the items, excluding the separating comma
+        if items and not first:
+            f.write(b",")
+        start = f.tell()
+        if items:
+            f.write(b",".join(_dumps(item) for item in items))
+        return start, f.tell()
+
+    def add_scan(self, scan_id, images, annotations):
+        img_start, img_end = self._write_items(self._out, images, self.num_images == 0)
+        ann_start, ann_end = self._write_items(self._anns, annotations, self.num_annotations == 0)
+        self.num_images += len(images)
+        self.num_annotations += len(annotations)
+        self.records.append((scan_id, img_start, img_end, ann_start, ann_end,
+                             images[0]["id"] if images else -1, len(images), len(annotations)))
+
+    def close(self):
+        self._out.write(b'],"annotations":[')
+        ann_offset = self._out.tell()
+        self._anns.seek(0)
+        shutil.copyfileobj(self._anns, self._out)
+        self._anns.close()
+        self._out.write(b'],"categories":' + _dumps(self.categories) + b"}")
+        self._out.close()
+        os.replace(self._tmp_path, self.json_path)
+
+        if self.index_path is not None:
+            index = np.array(self.records, dtype=index_dtype([rec[0] for rec in self.records]))
+            index["ann_start"] += ann_offset
+            index["ann_end"] += ann_offset
+            np.save(self.index_path, index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._out.close()
+            self._anns.close()
+            os.remove(self._tmp_path)
+
+def read_coco_index(index_path):
+    return np.load(index_path)
+
+def load_coco_scans(json_path, index, scan_ids=None):
+    """
+    Reads the images and annotations of the given scans by seeking into a COCO JSON written by
+    CocoStreamWriter, without parsing the rest of the file.
+
+    Returns:
+        dict: scan_id -> (images, annotations), for all scans in the index if scan_ids is None.
+    """
+    if scan_ids is not None:
+        scan_ids = set(scan_ids)
+    scans = {}
+    with open(json_path, "rb") as f:
+        for rec in index:
+            scan_id = str(rec["scan_id"])
+            if scan_ids is not None and scan_id not in scan_ids:
+                continue
+            parts = []
+            for start, end in ((rec["img_start"], rec["img_end"]), (rec["ann_start"], rec["ann_end"])):
+                f.seek(start)
+                parts.append(json.loads(b"[" + f.read(end - start) + b"]"))
+            scans[scan_id] = tuple(parts)
+    return scans
+
+def load_coco_categories(json_path):
+    # the categories are written last and are small, so only the tail of the file is read
+    key = b'"categories":'
+    with open(json_path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        tail_size = 4096
+        while True:
+            f.seek(max(0, size - tail_size))
+            tail = f.read()
+            pos = tail.rfind(key)
+            if pos >= 0:
+                return json.loads(tail[pos + len(key):-1])
+            if tail_size >= size:
+                raise ValueError(f"No categories found in {json_path}")
+            tail_size *= 2
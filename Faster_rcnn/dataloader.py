@@ -1,5 +1,11 @@
 import os
 import json
+import hashlib
+import zlib
+from contextlib import nullcontext
+from functools import partial
+from collections import defaultdict
+from multiprocessing import Pool
 import numpy as np
 import nibabel as nib
 import imageio
@@ -7,19 +13,294 @@ from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from nibabel.orientations import aff2axcodes
+from coco_io import CocoStreamWriter, coco_index_path
 
-def world_to_voxel(coord_mm, affine):
-    # print('coord_mm', coord_mm)
-    coord_mm = np.append(coord_mm, 1)  # make homogeneous
-    # print('coord_mm', coord_mm)
-    # print(affine)
-    # print(aff2axcodes(affine))
-    voxel = np.linalg.inv(affine).dot(coord_mm)
-    # print('voxel',voxel)
-    # print('other voxel', voxel)
-    return voxel[:3]  # return only x, y, z in voxel space
-
-def process_all_ct_scans(ct_folder, ann_folder, output_slices_folder, output_json_path, slicing_axis=2, roi_category_id=0):
+def world_to_voxel(coord_mm, affine=None, inv_affine=None):
+    # coord_mm is a single (3,) point or an (N, 3) batch of points,
+    # pass inv_affine to reuse the inverse of a volume instead of inverting its affine on every call
+    if inv_affine is None:
+        inv_affine = np.linalg.inv(affine)
+    coord_mm = np.asarray(coord_mm, dtype=np.float64)
+    voxel = coord_mm @ inv_affine[:3, :3].T + inv_affine[:3, 3]
+    return voxel  # x, y, z in voxel space
+
+def roi_slice_boxes(slice_phys, roi_plane_min, roi_plane_max, inv_affine, slicing_axis=2):
+    """
+    Converts the in-plane ROI extent into pixel boxes for a batch of slices in one call.
+
+    Parameters:
+        slice_phys (np.ndarray): (N,) physical positions of the slices along slicing_axis.
+        roi_plane_min, roi_plane_max (np.ndarray): in-plane ROI corners in mm.
+        inv_affine (np.ndarray): inverse affine of the scan.
+        slicing_axis (int): axis the slices are taken along.
+
+    Returns:
+        np.ndarray: (N, 4) boxes in COCO [x, y, width, height] format.
+    """
+    x0_mm = min(roi_plane_min[0], roi_plane_max[0])
+    x1_mm = max(roi_plane_min[0], roi_plane_max[0])
+    y0_mm = min(roi_plane_min[1], roi_plane_max[1])
+    y1_mm = max(roi_plane_min[1], roi_plane_max[1])
+
+    n = len(slice_phys)
+    corners_mm = np.empty((2 * n, 3))
+    corners_mm[:n, 0], corners_mm[:n, 1] = -x0_mm, -y0_mm
+    corners_mm[n:, 0], corners_mm[n:, 1] = -x1_mm, -y1_mm
+    corners_mm[:n, 2] = corners_mm[n:, 2] = slice_phys
+    corners_vox = world_to_voxel(corners_mm, inv_affine=inv_affine)
+
+    # axial uses voxel (x, y), sagittal (y, z) and coronal (x, z)
+    plane_axes = [ax for ax in range(3) if ax != slicing_axis]
+    v0 = corners_vox[:n, plane_axes]
+    v1 = corners_vox[n:, plane_axes]
+    return np.concatenate([np.minimum(v0, v1), np.abs(v1 - v0)], axis=1)
+
+def normalize_slice_uint8(slice_img):
+    # min-max scale a single slice to uint8, only this slice is promoted to float, never the whole volume
+    slice_min = slice_img.min()
+    slice_ptp = float(slice_img.max()) - float(slice_min)
+    slice_norm = np.subtract(slice_img, slice_min, dtype=np.float64)
+    slice_norm /= slice_ptp + 1e-8
+    slice_norm *= 255
+    return slice_norm.astype(np.uint8)
+
+def scan_paths(ct_filename, ct_folder, ann_folder):
+    ct_path = os.path.join(ct_folder, ct_filename)
+    ct_basename = os.path.splitext(os.path.splitext(ct_filename)[0])[0]
+    ann_path = os.path.join(ann_folder, ct_basename + ".mrk.json")
+    return ct_path, ct_basename, ann_path
+
+def file_signature(path, previous=None, content_hash=True):
+    """
+    Identifies a source file by size, mtime and sha1 of its content.
+
+    The content hash is only recomputed when size or mtime differ from the previous signature,
+    so unchanged scans cost a single stat call. With content_hash=False (full rebuilds) no hash is
+    computed and sha1 is None.
+
+    Returns:
+        dict or None: {"size", "mtime", "sha1"}, None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if previous is not None and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+        return previous
+    if not content_hash:
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": None}
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha1.hexdigest()}
+
+def same_content(sig_a, sig_b):
+    if sig_a is None or sig_b is None:
+        return sig_a is sig_b
+    if sig_a["sha1"] is None or sig_b["sha1"] is None:  # signature from a full rebuild, no content hash
+        return sig_a["size"] == sig_b["size"] and sig_a["mtime"] == sig_b["mtime"]
+    return sig_a["size"] == sig_b["size"] and sig_a["sha1"] == sig_b["sha1"]
+
+def select_slices(num_slices, positive_slices, max_negatives=None, negative_fraction=None, seed=0):
+    """
+    Keeps every positive slice plus a bounded subset of the negative (empty) slices.
+
+    Negatives are sampled without replacement with a probability that decays with the distance
+    (in slices) to the nearest positive slice, so hard negatives next to the box are favoured.
+    Scans without any positive slice are sampled uniformly.
+
+    Parameters:
+        num_slices (int): Number of slices along the slicing axis.
+        positive_slices (np.ndarray): Indices of the slices that carry a box.
+        max_negatives (int): Upper bound on the number of negatives kept, None for no bound.
+        negative_fraction (float): Fraction of the negatives kept, None to keep all of them.
+        seed (int): Seed of the sampling.
+
+    Returns:
+        np.ndarray: Sorted indices of the slices to export.
+    """
+    positive_slices = np.asarray(positive_slices, dtype=int)
+    is_negative = np.ones(num_slices, dtype=bool)
+    is_negative[positive_slices] = False
+    negatives = np.nonzero(is_negative)[0]
+
+    num_keep = len(negatives)
+    if negative_fraction is not None:
+        num_keep = int(round(negative_fraction * num_keep))
+    if max_negatives is not None:
+        num_keep = min(num_keep, max_negatives)
+    if num_keep >= len(negatives):
+        return np.arange(num_slices)
+
+    if len(positive_slices) > 0:
+        distance = np.abs(negatives[:, None] - positive_slices[None, :]).min(axis=1)
+        weights = 1.0 / distance
+    else:
+        weights = np.ones(len(negatives))
+    rng = np.random.default_rng(seed)
+    sampled = rng.choice(negatives, size=num_keep, replace=False, p=weights / weights.sum())
+    return np.sort(np.concatenate([positive_slices, sampled]))
+
+def process_ct_scan(ct_filename, ct_folder, ann_folder, output_slices_folder, slicing_axis=2, roi_category_id=0,
+                    max_negatives=None, negative_fraction=None, seed=0):
+    """
+    Exports the slices of a single CT scan and builds its COCO fragment.
+
+    All slices are exported unless max_negatives or negative_fraction is set, then only the slices with a box
+    and a subset of the empty ones are written (see select_slices). The sampling is seeded per scan.
+
+    Image ids are local to the scan (0..number of exported slices) and annotation ids start at 0,
+    process_all_ct_scans renumbers them when merging the fragments.
+
+    Returns:
+        (list, list): COCO image entries and annotation entries for this scan.
+    """
+    images = []
+    annotations = []
+
+    ct_path, ct_basename, ann_path = scan_paths(ct_filename, ct_folder, ann_folder)
+
+    roi_defined = False
+    if os.path.exists(ann_path):
+        with open(ann_path, 'r') as f:
+            ann_json = json.load(f)
+        if len(ann_json.get("markups", [])) > 0:
+            roi = ann_json["markups"][0]
+            roi_defined = True
+            center = np.array(roi["center"])
+            size = np.array(roi["size"])
+            orientation = np.array(roi["orientation"]).reshape(3, 3)
+            half_size = size / 2.0
+            corners_local = np.array([[dx, dy, dz]
+                                      for dx in (-half_size[0], half_size[0])
+                                      for dy in (-half_size[1], half_size[1])
+                                      for dz in (-half_size[2], half_size[2])])
+
+            # corners_world = center + corners_local.dot(orientation.T)
+            corners_world = center + corners_local
+            roi_axis_vals = corners_world[:, slicing_axis]
+            roi_axis_min = np.min(roi_axis_vals)
+            roi_axis_max = np.max(roi_axis_vals)
+
+            plane_axes = [ax for ax in range(3) if ax != slicing_axis]
+            roi_plane_min = np.min(corners_world[:, plane_axes], axis=0)
+            roi_plane_max = np.max(corners_world[:, plane_axes], axis=0)
+            # print(center, size, orientation)
+            print(corners_local)
+            print(corners_world)
+            # print("axis",roi_axis_min,roi_axis_max)
+            print(roi_plane_min,roi_plane_max)
+
+    ct_img = nib.load(ct_path)
+    # keep the on-disk dtype (e.g. int16) instead of get_fdata(), which would materialize a float64 copy
+    ct_data = np.asanyarray(ct_img.dataobj)
+
+    orig_spacing = ct_img.header.get_zooms()[:3]
+    orig_origin = ct_img.affine[:3, 3]
+
+    if slicing_axis != 0:
+        ct_data = np.moveaxis(ct_data, slicing_axis, 0)
+        spacing = [orig_spacing[slicing_axis]] + [orig_spacing[i] for i in range(3) if i != slicing_axis]
+        origin = [orig_origin[slicing_axis]] + [orig_origin[i] for i in range(3) if i != slicing_axis]
+    else:
+        spacing = orig_spacing
+        origin = orig_origin
+
+    spacing = np.array(spacing)
+    origin = np.array(origin)
+    # origin = origin[::-1]
+    num_slices = ct_data.shape[0]
+    slice_height = ct_data.shape[1]
+    slice_width = ct_data.shape[2]
+    ct_output_folder = os.path.join(output_slices_folder, ct_basename)
+    os.makedirs(ct_output_folder, exist_ok=True)
+
+    # all ROI boxes of the scan are converted in one batch, with the affine inverted once per scan
+    slice_boxes = {}
+    roi_slices = np.zeros(0, dtype=int)
+    if roi_defined:
+        slice_phys = origin[0] + np.arange(num_slices) * spacing[0]
+        roi_slices = np.nonzero((roi_axis_min <= slice_phys) & (slice_phys <= roi_axis_max))[0]
+        boxes = roi_slice_boxes(slice_phys[roi_slices], roi_plane_min, roi_plane_max,
+                                np.linalg.inv(ct_img.affine), slicing_axis)
+        slice_boxes = dict(zip(roi_slices.tolist(), boxes.tolist()))
+
+    export_slices = select_slices(num_slices, roi_slices, max_negatives, negative_fraction,
+                                  seed=[seed, zlib.crc32(ct_basename.encode())])
+
+    for i in export_slices.tolist():
+        slice_norm = normalize_slice_uint8(ct_data[i, :, :])
+        slice_corrected = np.fliplr(np.rot90(slice_norm, k=-1))
+        slice_filename = f"{ct_basename}_slice_{i:03d}.png"
+        slice_filepath = os.path.join(ct_output_folder, slice_filename)
+        imageio.imwrite(slice_filepath, slice_corrected)
+
+        image_entry = {
+            "id": len(images),
+            "file_name": slice_filepath,
+            "width": slice_width,
+            "height": slice_height
+        }
+        images.append(image_entry)
+
+        if i in slice_boxes:
+            bbox_x, bbox_y, bbox_width, bbox_height = slice_boxes[i]
+            area = bbox_width * bbox_height
+
+            annotation_entry = {
+                "id": len(annotations),
+                "image_id": image_entry["id"],
+                "category_id": roi_category_id,
+                "bbox": [bbox_x, bbox_y, bbox_width, bbox_height],
+                "area": area,
+                "iscrowd": 0
+            }
+            annotations.append(annotation_entry)
+
+    print(f"Processed CT scan '{ct_basename}': {len(images)} of {num_slices} slices saved in {ct_output_folder}")
+    return images, annotations
+
+def merge_coco_fragments(coco, fragments, first_image_id=0, first_annotation_id=1):
+    """
+    Appends per-scan (images, annotations) fragments to coco in the given order,
+    shifting the scan-local ids to global ones.
+
+    Returns:
+        (int, int): next free image id and annotation id.
+    """
+    image_id = first_image_id
+    annotation_id = first_annotation_id
+    for images, annotations in fragments:
+        image_offset = image_id
+        for img in images:
+            img["id"] += image_offset
+            coco["images"].append(img)
+        for ann in annotations:
+            ann["id"] = annotation_id
+            ann["image_id"] += image_offset
+            coco["annotations"].append(ann)
+            annotation_id += 1
+        image_id += len(images)
+    return image_id, annotation_id
+
+def process_all_ct_scans(ct_folder, ann_folder, output_slices_folder, output_json_path, slicing_axis=2, roi_category_id=0,
+                         num_workers=1, incremental=False, write_index=False, max_negatives=None,
+                         negative_fraction=None, seed=0):
+    """
+    Exports the slices of every CT scan in ct_folder and writes one combined COCO JSON.
+
+    With incremental=True a manifest next to output_json_path records the source signature of every scan
+    (CT volume and annotation file) and its image id range. Scans whose sources are unchanged and whose
+    slices still exist are kept as they are, only new or changed scans are exported and appended to the
+    existing COCO output. Scans that disappeared from ct_folder are dropped.
+
+    The COCO JSON is streamed to disk in compact form, one scan at a time. With write_index=True a
+    binary <output>_index.npy maps every scan id to the byte ranges of its images and annotations,
+    see coco_io.load_coco_scans.
+
+    max_negatives and negative_fraction bound the number of empty slices exported per scan, slices with a
+    box are always kept (see select_slices).
+    """
     coco = {
         "images": [],
         "annotations": [],
@@ -27,157 +308,77 @@ def process_all_ct_scans(ct_folder, ann_folder, output_slices_folder, output_jso
             {"id": roi_category_id, "name": "ROI", "supercategory": "none"}
         ]
     }
-    global_image_id = 1
-    global_annotation_id = 1
-
-    ct_files = [f for f in os.listdir(ct_folder) if f.endswith(".nii") or f.endswith(".nii.gz")]
-
-    for ct_filename in sorted(ct_files):
-        ct_path = os.path.join(ct_folder, ct_filename)
-        ct_basename = os.path.splitext(os.path.splitext(ct_filename)[0])[0]
-        ann_path = os.path.join(ann_folder, ct_basename + ".mrk.json")
-
-        roi_defined = False
-        if os.path.exists(ann_path):
-            with open(ann_path, 'r') as f:
-                ann_json = json.load(f)
-            if len(ann_json.get("markups", [])) > 0:
-                roi = ann_json["markups"][0]
-                roi_defined = True
-                center = np.array(roi["center"])
-                size = np.array(roi["size"])
-                orientation = np.array(roi["orientation"]).reshape(3, 3)
-                half_size = size / 2.0
-                corners_local = np.array([[dx, dy, dz]
-                                          for dx in (-half_size[0], half_size[0])
-                                          for dy in (-half_size[1], half_size[1])
-                                          for dz in (-half_size[2], half_size[2])])
-                
-                # corners_world = center + corners_local.dot(orientation.T)
-                corners_world = center + corners_local
-                roi_axis_vals = corners_world[:, slicing_axis]
-                roi_axis_min = np.min(roi_axis_vals)
-                roi_axis_max = np.max(roi_axis_vals)
-                
-                plane_axes = [ax for ax in range(3) if ax != slicing_axis]
-                roi_plane_min = np.min(corners_world[:, plane_axes], axis=0)
-                roi_plane_max = np.max(corners_world[:, plane_axes], axis=0)
-                # print(center, size, orientation)
-                print(corners_local)
-                print(corners_world)
-                # print("axis",roi_axis_min,roi_axis_max)
-                print(roi_plane_min,roi_plane_max)
-        
-        ct_img = nib.load(ct_path)
-        ct_data = ct_img.get_fdata()
-        
-        orig_spacing = ct_img.header.get_zooms()[:3]
-        orig_origin = ct_img.affine[:3, 3]
-
-        if slicing_axis != 0:
-            ct_data = np.moveaxis(ct_data, slicing_axis, 0)
-            spacing = [orig_spacing[slicing_axis]] + [orig_spacing[i] for i in range(3) if i != slicing_axis]
-            origin = [orig_origin[slicing_axis]] + [orig_origin[i] for i in range(3) if i != slicing_axis]
-        else:
-            spacing = orig_spacing
-            origin = orig_origin
-
-        spacing = np.array(spacing)
-        origin = np.array(origin)
-        # origin = origin[::-1]
-        num_slices = ct_data.shape[0]
-        slice_height = ct_data.shape[1]
-        slice_width = ct_data.shape[2]
-        # print(ct_img.header)
-        # print('orig_origin',orig_origin)
-        # print('orig_spacing',orig_spacing)
-        # print('spacing',spacing)
-        # print('origin',origin)
-        # print('axial',num_slices)
-        # print('sagital',slice_height)
-        # print('coronal',slice_width)
-        ct_output_folder = os.path.join(output_slices_folder, ct_basename)
-        os.makedirs(ct_output_folder, exist_ok=True)
-        count = 1
-        for i in range(num_slices):
-            slice_phys = origin[0] + i * spacing[0]
-            slice_img = ct_data[i, :, :]
-            slice_norm = ((slice_img - np.min(slice_img)) / (np.ptp(slice_img) + 1e-8) * 255).astype(np.uint8)
-            slice_corrected = np.fliplr(np.rot90(slice_norm, k=-1)) 
-            slice_filename = f"{ct_basename}_slice_{i:03d}.png"
-            slice_filepath = os.path.join(ct_output_folder, slice_filename)
-            imageio.imwrite(slice_filepath, slice_corrected)
-            
-            # print(slice_phys)
-            # print(slice_img)
-            image_entry = {
-                "id": global_image_id-1,
-                "file_name": slice_filepath,
-                "width": slice_width,
-                "height": slice_height
-            }
-            coco["images"].append(image_entry)
-            # print(roi_defined, roi_axis_min ,'<=', slice_phys ,'<=', roi_axis_max)
-        
-            if roi_defined and (roi_axis_min <= slice_phys <= roi_axis_max):
-                
-                x0_mm = min(roi_plane_min[0], roi_plane_max[0])
-                x1_mm = max(roi_plane_min[0], roi_plane_max[0])
-                y0_mm = min(roi_plane_min[1], roi_plane_max[1])
-                y1_mm = max(roi_plane_min[1], roi_plane_max[1])
-                # print('x0', x0_mm)
-                # print('x1',x1_mm)
-                # print('y0', y0_mm)
-                # print('y1', y1_mm)
-                # print('slice_phys',slice_phys)
-                v0 = world_to_voxel([-x0_mm, -y0_mm, slice_phys], ct_img.affine)
-                v1 = world_to_voxel([-x1_mm, -y1_mm, slice_phys], ct_img.affine)
-                # print('v0',v0)
-                # print('v1', v1)
-                
-                if slicing_axis == 2:  # axial
-                    x0_px, y0_px = v0[0], v0[1]
-                    x1_px, y1_px = v1[0], v1[1]
-                elif slicing_axis == 0:  # sagittal
-                    x0_px, y0_px = v0[1], v0[2]
-                    x1_px, y1_px = v1[1], v1[2]
-                elif slicing_axis == 1:  # coronal
-                    x0_px, y0_px = v0[0], v0[2]
-                    x1_px, y1_px = v1[0], v1[2]
-
-
-            
-                bbox_x = float(min(x0_px, x1_px))
-                bbox_y = float(min(y0_px, y1_px))
-                bbox_width = float(abs(x1_px - x0_px))
-                bbox_height = float(abs(y1_px - y0_px))
-                
-                # print("Expected pixel X range:", (x0_mm - origin[1]) / spacing[1], (x1_mm - origin[1]) / spacing[1])
-                # print("Expected pixel Y range:", (y0_mm - origin[2]) / spacing[2], (y1_mm - origin[2]) / spacing[2])
-                # print("Image shape (H x W):", ct_data.shape[1], ct_data.shape[2])
-                # print("v0:", v0)
-                # print("v1:", v1)
-                # print("bbox_y before flip:", bbox_y)
-                # print("bbox_y after flip:", slice_height - bbox_y - bbox_height)
-                area = bbox_width * bbox_height
-
-                annotation_entry = {
-                    "id": global_annotation_id,
-                    "image_id": global_image_id-1,
-                    "category_id": roi_category_id,
-                    "bbox": [bbox_x, bbox_y, bbox_width, bbox_height],
-                    "area": area,
-                    "iscrowd": 0
-                }
-                coco["annotations"].append(annotation_entry)
-                global_annotation_id += 1
-
-            global_image_id += 1
-
-        print(f"Processed CT scan '{ct_basename}': {num_slices} slices saved in {ct_output_folder}")
-
-    with open(output_json_path, 'w') as f:
-        json.dump(coco, f, indent=4)
+    params = {"output_slices_folder": output_slices_folder, "slicing_axis": slicing_axis,
+              "roi_category_id": roi_category_id, "max_negatives": max_negatives,
+              "negative_fraction": negative_fraction, "seed": seed}
+    manifest_path = os.path.splitext(output_json_path)[0] + "_scans.json"
+    old_scans = {}
+    if incremental and os.path.exists(manifest_path) and os.path.exists(output_json_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get("params") == params:
+            with open(output_json_path, 'r') as f:
+                coco = json.load(f)
+            old_scans = manifest["scans"]
+
+    ct_files = sorted(f for f in os.listdir(ct_folder) if f.endswith(".nii") or f.endswith(".nii.gz"))
+
+    images_by_id = {img["id"]: img for img in coco["images"]}
+    scans = {}
+    to_export = []
+    for ct_filename in ct_files:
+        ct_path, ct_basename, ann_path = scan_paths(ct_filename, ct_folder, ann_folder)
+        old = old_scans.get(ct_filename, {})
+        entry = {"ct": file_signature(ct_path, old.get("ct"), incremental),
+                 "ann": file_signature(ann_path, old.get("ann"), incremental)}
+        if old and same_content(old["ct"], entry["ct"]) and same_content(old["ann"], entry["ann"]):
+            image_ids = range(old["first_image_id"], old["first_image_id"] + old["num_images"])
+            if all(i in images_by_id and os.path.exists(images_by_id[i]["file_name"]) for i in image_ids):
+                entry.update(first_image_id=old["first_image_id"], num_images=old["num_images"])
+                scans[ct_filename] = entry
+                continue
+        scans[ct_filename] = entry
+        to_export.append(ct_filename)
+
+    # entries of scans that changed or no longer exist are dropped, the kept scans are written back first
+    kept = sorted((entry["first_image_id"], ct_filename) for ct_filename, entry in scans.items()
+                  if "first_image_id" in entry)
+    anns_by_image = defaultdict(list)
+    for ann in coco["annotations"]:
+        anns_by_image[ann["image_id"]].append(ann)
+    if old_scans:
+        print(f"Incremental update: keeping {len(kept)} scans, exporting {len(to_export)}")
+
+    export_scan = partial(process_ct_scan, ct_folder=ct_folder, ann_folder=ann_folder,
+                          output_slices_folder=output_slices_folder, slicing_axis=slicing_axis,
+                          roi_category_id=roi_category_id, max_negatives=max_negatives,
+                          negative_fraction=negative_fraction, seed=seed)
+
+    image_id = max((first + scans[ct_filename]["num_images"] for first, ct_filename in kept), default=0)
+    annotation_id = 1
+
+    index_path = coco_index_path(output_json_path) if write_index else None
+    if index_path is None and os.path.exists(coco_index_path(output_json_path)):
+        os.remove(coco_index_path(output_json_path))  # a stale index would point at the wrong byte ranges
+    with CocoStreamWriter(output_json_path, coco["categories"], index_path) as writer:
+        for first_image_id, ct_filename in kept:
+            images = [images_by_id[i] for i in range(first_image_id, first_image_id + scans[ct_filename]["num_images"])]
+            annotations = [ann for img in images for ann in anns_by_image[img["id"]]]
+            writer.add_scan(scan_paths(ct_filename, ct_folder, ann_folder)[1], images, annotations)
+            annotation_id = max([annotation_id] + [ann["id"] + 1 for ann in annotations])
+        del coco, images_by_id, anns_by_image
+
+        # every scan is exported independently; fragments come back in sorted file order so ids stay deterministic
+        with Pool(num_workers) if num_workers > 1 else nullcontext() as pool:
+            fragments = pool.imap(export_scan, to_export) if pool is not None else map(export_scan, to_export)
+            for ct_filename, fragment in zip(to_export, fragments):
+                scans[ct_filename].update(first_image_id=image_id, num_images=len(fragment[0]))
+                part = {"images": [], "annotations": []}
+                image_id, annotation_id = merge_coco_fragments(part, [fragment], image_id, annotation_id)
+                writer.add_scan(scan_paths(ct_filename, ct_folder, ann_folder)[1], part["images"], part["annotations"])
+
+    with open(manifest_path, 'w') as f:
+        json.dump({"params": params, "scans": scans}, f)
     print(f"Combined COCO JSON saved to {output_json_path}")
 # Example usage:
 if __name__ == "__main__":
@@ -186,7 +387,7 @@ if __name__ == "__main__":
     output_slices_folder = "/home/tarobben/scratch/MedYOLO/nifticheck/yolo/"   # Where subfolders for each CT will be created
     output_json_path = "/home/tarobben/scratch/MedYOLO/nifticheck/yolo/"  # Combined COCO-style JSON file for all slices
     # slicing_axis: 0 for axial, 1 for coronal, 2 for sagittal (default is 0)
-    process_all_ct_scans(ct_folder, ann_folder, output_slices_folder, output_json_path, slicing_axis=2)
+    process_all_ct_scans(ct_folder, ann_folder, output_slices_folder, output_json_path, slicing_axis=2, num_workers=8)
 
 
 def show_slice_with_bbox(png_path, bbox, rotation_k=-1):
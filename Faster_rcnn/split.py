@@ -2,28 +2,43 @@ import json
 import random
 import os
 from collections import defaultdict
+from coco_io import (CocoStreamWriter, coco_index_path, load_coco_categories, load_coco_scans,
+                     read_coco_index)
 
 def extract_scan_id(file_name):
     return file_name.split("/")[-2]  # e.g., CT001 from CT001/CT001_slice_012.png
 
-def scan_split_coco(json_path, out_train, out_val, val_ratio=0.2, seed=42):
-    with open(json_path, "r") as f:
-        coco = json.load(f)
+def group_coco_by_scan(json_path):
+    """
+    Groups the images and annotations of a COCO JSON by scan id in a single pass.
 
-    images = coco["images"]
-    annotations = coco["annotations"]
-    categories = coco["categories"]
+    If the JSON was written with a scan index (see coco_io), the groups are read by seeking
+    into the file instead of parsing it as a whole.
 
-    # Group annotations by image_id
-    anns_by_image = defaultdict(list)
-    for ann in annotations:
-        anns_by_image[ann["image_id"]].append(ann)
+    Returns:
+        (dict, list): scan_id -> (images, annotations) in file order, and the categories.
+    """
+    index_path = coco_index_path(json_path)
+    if os.path.exists(index_path):
+        return load_coco_scans(json_path, read_coco_index(index_path)), load_coco_categories(json_path)
+
+    with open(json_path, "r") as f:
+        coco = json.load(f)
 
-    # Group images by scan ID
-    scans = defaultdict(list)
-    for img in images:
+    scans = {}
+    scan_of_image = {}
+    for img in coco["images"]:
         scan_id = extract_scan_id(img["file_name"])
-        scans[scan_id].append(img)
+        scan_of_image[img["id"]] = scan_id
+        scans.setdefault(scan_id, ([], []))[0].append(img)
+    for ann in coco["annotations"]:
+        scan_id = scan_of_image.get(ann["image_id"])
+        if scan_id is not None:
+            scans[scan_id][1].append(ann)
+    return scans, coco["categories"]
+
+def scan_split_coco(json_path, out_train, out_val, val_ratio=0.2, seed=42):
+    scans, categories = group_coco_by_scan(json_path)
 
     print(f"Total scans: {len(scans)}")
 
@@ -32,38 +47,18 @@ def scan_split_coco(json_path, out_train, out_val, val_ratio=0.2, seed=42):
     random.seed(seed)
     random.shuffle(all_scan_ids)
     val_size = int(len(all_scan_ids) * val_ratio)
-    val_scan_ids = set(all_scan_ids[:val_size])
-    train_scan_ids = set(all_scan_ids[val_size:])
-
-    # Gather images for each split
-    train_images = []
-    val_images = []
-
-    for sid in train_scan_ids:
-        train_images.extend(scans[sid])
-    for sid in val_scan_ids:
-        val_images.extend(scans[sid])
-
-    # Get image IDs
-    train_ids = {img["id"] for img in train_images}
-    val_ids = {img["id"] for img in val_images}
-
-    # Filter annotations by split
-    train_anns = [ann for ann in annotations if ann["image_id"] in train_ids]
-    val_anns = [ann for ann in annotations if ann["image_id"] in val_ids]
-
-    # Helper to write out new JSON
-    def save_json(path, imgs, anns):
-        with open(path, "w") as f:
-            json.dump({
-                "images": imgs,
-                "annotations": anns,
-                "categories": categories
-            }, f, indent=4)
-        print(f"Wrote {len(imgs)} images and {len(anns)} annotations to {path}")
-
-    save_json(out_train, train_images, train_anns)
-    save_json(out_val, val_images, val_anns)
+
+    # Emit both splits in one pass over the scans
+    writers = {
+        "train": CocoStreamWriter(out_train, categories),
+        "val": CocoStreamWriter(out_val, categories),
+    }
+    for i, sid in enumerate(all_scan_ids):
+        writers["val" if i < val_size else "train"].add_scan(sid, *scans[sid])
+
+    for writer in writers.values():
+        writer.close()
+        print(f"Wrote {writer.num_images} images and {writer.num_annotations} annotations to {writer.json_path}")
 
 # 🔧 Example usage:
 # scan_split_coco(
@@ -8,6 +8,7 @@ import argparse
 import os
 import sys
 from pathlib import Path
+import numpy as np
 import torch
 
 # set path for local imports
@@ -19,16 +20,18 @@ ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 # 2D YOLO imports
 from utils.general import print_args, increment_path, check_suffix, check_img_size, colorstr
-from utils.torch_utils import select_device
+from utils.torch_utils import select_device, time_sync
 
 # 3D YOLO imports
 from models3D.model import attempt_load
 from utils3D.datasets import LoadNiftis
-from utils3D.general import non_max_suppression, scale_coords, zxyzxy2zxydwh
+from utils3D.general import non_max_suppression, scale_coords, clip_coords, label_rows, write_label_rows, save_prediction_table
+from utils3D.sliding_window import sliding_window_predict
 
 
 # Configuration
 default_size = 350 # edge length for testing
+LOG_LEVELS = ('quiet', 'info', 'debug')
 
 
 @torch.no_grad()
@@ -41,13 +44,21 @@ def run(weights,  # model.pt path(s)
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         save_txt=False,  # save results to *.txt
         save_conf=False,  # save confidences in --save-txt labels
+        save_table=None,  # save all predictions of the run to one predictions.csv or predictions.npy, options: csv, npy
         classes=None,  # filter by class: --class 0, or --class 0 2 3
         agnostic_nms=False,  # class-agnostic NMS
         project=ROOT / 'runs/detect',  # save results to project/name
         name='exp',  # save results to project/name
         exist_ok=False,  # existing project/name ok, do not increment
         half=False,  # use FP16 half-precision inference
-        norm='CT'  # normalization mode, options: CT, MR, Other
+        norm='CT',  # normalization mode, options: CT, MR, Other
+        batch_size=1,  # number of volumes (or windows with --tile) per forward pass
+        workers=4,  # dataloader worker processes decoding and resizing upcoming volumes
+        tile=False,  # sliding-window inference at native resolution instead of resizing to one cube
+        tile_spacing=None,  # voxel size in mm the model sees with --tile, nifti axis order, one value for isotropic
+        tile_overlap=0.25,  # fraction of overlap between neighbouring windows
+        log_level='info',  # console output, options: quiet (summary only), info (one line per volume), debug (full detections)
+        top_k=3  # number of highest confidences reported per volume
         ):
     source = str(source)
 
@@ -71,22 +82,24 @@ def run(weights,  # model.pt path(s)
         model.half()  # to FP16
     imgsz = check_img_size(imgsz, s=stride)[0]  # check image size - since cubic only need one index
     
-    # Dataloader
-    dataset = LoadNiftis(source, img_size=imgsz, stride=stride)
-    
-    # Run inference
-    if device.type != 'cpu':
-        model(torch.zeros(1, 1, imgsz, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
-    
-    seen = 0
-    
-    for path, img, im0s in dataset:
+    # Dataloader, workers prefetch the next batches while the current one runs
+    # with --tile every item is one full volume at native resolution, batch_size then counts windows
+    dataset = LoadNiftis(source, img_size=imgsz, stride=stride, native=tile)
+    nw = min(os.cpu_count(), workers)
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=None if tile else batch_size,
+                                         shuffle=False,
+                                         num_workers=nw,
+                                         pin_memory=device.type != 'cpu',
+                                         collate_fn=None if tile else LoadNiftis.collate_fn)
+    if tile_spacing is not None:
+        tile_spacing = list(tile_spacing) * 3 if len(tile_spacing) == 1 else list(tile_spacing)
+        tile_spacing = (tile_spacing[2], tile_spacing[0], tile_spacing[1])  # nifti order to depth, height, width
+
+    def preprocess(img):
         img = img.to(device, non_blocking=True)
         img = img.half() if half else img.float()  # uint8 to fp16/32
 
-        if len(img.shape) == 4: # if only has channel, z, x, y dimensions but no batch
-            img = img[None]  # expand for batch dim
-        
         if norm.lower() == 'ct':
             # Normalization for Hounsfield units, may see performance improvements by clipping images to +/- 1024.
             img = (img + 1024.) / 2048.0  # int to float32, -1024-1024 to 0.0-1.0
@@ -96,53 +109,100 @@ def run(weights,  # model.pt path(s)
             img = (img - mean)/std_dev
         else:
             raise NotImplementedError("You'll need to write your own normalization algorithm here.")
-        
+        return img
+    
+    # Run inference
+    if device.type != 'cpu':
+        model(torch.zeros(1, 1, imgsz, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
+    
+    verbosity = LOG_LEVELS.index(log_level)
+    seen, dt = 0, [0.0, 0.0, 0.0]
+    table_names, table_rows = [], []  # --save-table rows of all volumes
+    
+    for batch in loader:
         # Inference
-        pred = model(img)[0]
-        print(pred)
+        t1 = time_sync()
+        if tile:
+            # window predictions are already in voxel coordinates of the volume and get merged by NMS below
+            path, volume, spacing = batch
+            paths, shapes0 = [path], [volume.permute(1, 2, 0).shape]  # original height, width, depth order
+            t2 = t1  # windows are preprocessed inside sliding_window_predict
+            pred = sliding_window_predict(model, volume, spacing, imgsz, tile_spacing, tile_overlap, batch_size, preprocess)
+        else:
+            paths, img, shapes0 = batch
+            img = preprocess(img)
+            t2 = time_sync()
+            pred = model(img)[0]
+        t3 = time_sync()
+        if verbosity >= 2:
+            print(f'\nraw predictions {tuple(pred.shape)}:\n{pred}')
+
         # NMS
-        pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, multi_label=True, max_det=max_det)
+        pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, multi_label=True, max_det=max_det,
+                                   batched=device.type != 'cpu')
+        t4 = time_sync()
+        dt[0] += t2 - t1
+        dt[1] += t3 - t2
+        dt[2] += t4 - t3
         
         # Process predictions
-        for _, det in enumerate(pred):  # per image
+        for i, det in enumerate(pred):  # per image
             seen += 1
-            p, s, im0, _ = path, '', im0s.clone(), getattr(dataset, 'frame', 0)
+            p, s, im0_shape = Path(paths[i]), '', shapes0[i]
 
-            p = Path(p)  # to Path
             if p.name[-4:] == '.nii':
                 txt_path = str(save_dir / 'labels' / p.name[:-4])  # img.txt
             elif p.name[-7:] == '.nii.gz':
                 txt_path = str(save_dir / 'labels' / p.name[:-7])  # img.txt
-            s += '%gx%gx%g ' % img.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[2, 1, 0, 2, 1, 0]]  # normalization gain dwhdwh - might be [[2, 0, 1, 2, 0, 1]], hard to tell with cubic/square input
+            s += '%gx%gx%g ' % ((imgsz,) * 3)  # print string
+            gn = torch.tensor(im0_shape)[[2, 1, 0, 2, 1, 0]]  # normalization gain dwhdwh - might be [[2, 0, 1, 2, 0, 1]], hard to tell with cubic/square input
             
             if len(det):
                 # Rescale boxes from img_size to im0 size
-                im0_reshape = [im0.shape[2], im0.shape[1], im0.shape[0]]
-                det[:, :6] = scale_coords(img.shape[2:], det[:, :6], im0_reshape).round()
+                im0_reshape = [im0_shape[2], im0_shape[1], im0_shape[0]]
+                if tile:
+                    clip_coords(det[:, :6], im0_reshape)
+                    det[:, :6] = det[:, :6].round()
+                else:
+                    det[:, :6] = scale_coords((imgsz,) * 3, det[:, :6], im0_reshape).round()
                 
                 # Print results
                 for c in det[:, -1].unique():
                     n = (det[:, -1] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
                 
-                # testing since default run doesn't set save_txt=True
-                for *zxyzxy, conf, cls in reversed(det):
-                    zxydwh = (zxyzxy2zxydwh(torch.tensor(zxyzxy).view(1, 6)) / gn).view(-1).tolist()  # normalized zxydwh
-                    line = (cls, *zxydwh, conf)  # label format
-                    print('\ncls z x y d w h conf')
-                    print(('%g ' * len(line)).rstrip() % line)
-                    
-                # Write results
-                if save_txt:  # Write to file
-                    for *zxyzxy, conf, cls in reversed(det):
-                        zxydwh = (zxyzxy2zxydwh(torch.tensor(zxyzxy).view(1, 6)) / gn).view(-1).tolist()  # normalized zxydwh
-                        line = (cls, *zxydwh, conf) if save_conf else (cls, *zxydwh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-                            
-    if save_txt: # or save_img:
+                s += 'top conf ' + ' '.join(f'{c:.3f}' for c in det[:top_k, 6].tolist()) + ', '  # det is sorted by conf
+            else:
+                s += '(no detections), '
+
+            # Report, timings are for the whole batch the volume was part of
+            if verbosity >= 1:
+                print(f'image {seen}/{len(dataset)} {p}: {s}{t3 - t2:.3f}s inference, {t4 - t3:.3f}s NMS')
+
+            if len(det):
+                # Write results, one write per volume
+                if save_txt or save_table or verbosity >= 2:
+                    rows = label_rows(det.flip(0), gn)  # cls, normalized zxydwh, conf
+                    if verbosity >= 2:
+                        print('cls z x y d w h conf\n' + ''.join(('%g ' * len(row)).rstrip() % tuple(row) + '\n' for row in rows.tolist()), end='')
+                    if save_txt:  # Write to file
+                        write_label_rows(txt_path + '.txt', rows if save_conf else rows[:, :7])
+                    if save_table:
+                        table_names += [p.name] * len(rows)
+                        table_rows.append(rows)
+
+    # Print results
+    if verbosity >= 1:
+        t = tuple(x / max(seen, 1) * 1E3 for x in dt)  # speeds per volume
+        print(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per volume at shape {(1, 1, imgsz, imgsz, imgsz)}' % t)
+
+    if save_table:
+        table_rows = torch.cat(table_rows).numpy() if table_rows else np.zeros((0, 8), dtype=np.float32)
+        save_prediction_table(save_dir / f'predictions.{save_table}', table_names, table_rows)
+
+    if save_txt or save_table:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
+        s += f"\n{len(table_names)} predictions saved to {save_dir / f'predictions.{save_table}'}" if save_table else ''
         print(f"Results saved to {colorstr('bold', save_dir)}{s}")
 
 
@@ -157,6 +217,7 @@ def parse_opt():
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
+    parser.add_argument('--save-table', choices=['csv', 'npy'], help='save all predictions of the run to one csv or npy file')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --classes 0, or --classes 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     parser.add_argument('--project', default=ROOT / 'runs/detect', help='save results to project/name')
@@ -164,6 +225,13 @@ def parse_opt():
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--norm', type=str, default='CT', help='normalization type, options: CT, MR, Other')
+    parser.add_argument('--batch-size', type=int, default=1, help='number of volumes per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of dataloader workers')
+    parser.add_argument('--tile', action='store_true', help='sliding-window inference at native resolution')
+    parser.add_argument('--tile-spacing', nargs='+', type=float, help='voxel size in mm for --tile windows, one value or three in nifti axis order')
+    parser.add_argument('--tile-overlap', type=float, default=0.25, help='fraction of overlap between --tile windows')
+    parser.add_argument('--log-level', default='info', choices=LOG_LEVELS, help='console output, debug also dumps all detections')
+    parser.add_argument('--top-k', type=int, default=3, help='number of highest confidences reported per volume')
     opt = parser.parse_args()
     print_args(FILE.stem, opt)
     return opt
@@ -42,6 +42,7 @@ from utils.plots import plot_evolve
 # 3D YOLO imports
 from models3D.model import Model, attempt_load
 from utils3D.datasets import nifti_dataloader, normalize_CT, normalize_MR
+from utils3D.augmentations import batch_random_zoom, batch_tensor_cutout
 from utils3D.lossandmetrics import ComputeLossVF
 from utils3D.anchors import nifti_check_anchors
 from utils3D.general import check_dataset
@@ -166,7 +167,12 @@ def train(hyp, opt, device, callbacks):
                                                    stride=stride,
                                                    rank=LOCAL_RANK,
                                                    workers=workers,
-                                                   augment=True)
+                                                   augment=True,
+                                                   sample_weights=data_dict.get('train_weights'),
+                                                   check_images=opt.check_images,
+                                                   cache_images=opt.cache,
+                                                   cache_dtype=opt.cache_dtype,
+                                                   device_augment=opt.device_augment)
     mlc = int(np.concatenate(train_dataset.labels, 0)[:, 0].max())  # max label class
     nb = len(train_loader)  # number of batches
     assert mlc < nc, f'Label class {mlc} exceeds nc={nc} in {data}. Possible class labels are 0-{nc - 1}'
@@ -178,12 +184,16 @@ def train(hyp, opt, device, callbacks):
                                       batch_size=batch_size,
                                       stride=stride,
                                       single_cls=single_cls,
-                                      workers=workers)[0]
+                                      workers=workers,
+                                      check_images=opt.check_images,
+                                      cache_images=opt.cache,
+                                      cache_dtype=opt.cache_dtype)[0]
 
         if not resume:
             # Anchors
             if not opt.noautoanchor:
-                nifti_check_anchors(train_dataset, model=model, thr=hyp['anchor_t'], imgsz=imgsz)
+                nifti_check_anchors(train_dataset, model=model, thr=hyp['anchor_t'], imgsz=imgsz,
+                                    max_labels=opt.autoanchor_labels or None)
             model.half().float()  # pre-reduce anchor precision
 
         callbacks.run('on_pretrain_routine_end')
@@ -229,11 +239,16 @@ def train(hyp, opt, device, callbacks):
         # train loop
         for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
             ni = i + nb * epoch  # number integrated batches (since train start)
+            imgs = imgs.to(device, non_blocking=True).float()
+            if opt.device_augment:  # random zoom and cutout on the training device, parameters drawn per volume
+                imgs, targets = batch_random_zoom(imgs, targets, hyp['max_zoom'], hyp['min_zoom'], hyp['prob_zoom'])
+                imgs, targets = batch_tensor_cutout(imgs, targets, hyp['cutout_params'], hyp['prob_cutout'])
+
             # Normalization
             if norm.lower() == 'ct':
-                imgs = normalize_CT(imgs.to(device, non_blocking=True).float())  # int to float32, -1024-1024 to 0.0-1.0
+                imgs = normalize_CT(imgs)  # int to float32, -1024-1024 to 0.0-1.0
             elif norm.lower() == 'mr':
-                imgs = normalize_MR(imgs.to(device, non_blocking=True).float())  # int to float32, mean 0 std dev
+                imgs = normalize_MR(imgs)  # int to float32, mean 0 std dev
             else:
                 raise NotImplementedError("You'll need to write your own normalization algorithm here.")
 
@@ -376,6 +391,7 @@ def parse_opt(known=False):
     parser.add_argument('--nosave', action='store_true', help='only save final checkpoint')
     parser.add_argument('--noval', action='store_true', help='only validate final epoch')
     parser.add_argument('--noautoanchor', action='store_true', help='disable autoanchor check')
+    parser.add_argument('--autoanchor-labels', type=int, default=0, help='max label boxes sampled for autoanchor, 0 for all')
     parser.add_argument('--evolve', type=int, nargs='?', const=300, help='evolve hyperparameters for x generations')
     parser.add_argument('--image-weights', action='store_true', help='use weighted image selection for training')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
@@ -391,6 +407,10 @@ def parse_opt(known=False):
     parser.add_argument('--save-period', type=int, default=-1, help='Save checkpoint every x epochs (disabled if < 1)')
     parser.add_argument('--local_rank', type=int, default=-1, help='DDP parameter, do not modify')
     parser.add_argument('--norm', type=str, default='CT', help='normalization type, options: CT, MR, Other')
+    parser.add_argument('--check-images', action='store_true', help='fully decompress images when building the label cache')
+    parser.add_argument('--cache', type=str, nargs='?', const='ram', help='--cache preprocessed volumes in "ram" (default) or "disk"')
+    parser.add_argument('--cache-dtype', type=str, default='float16', help='dtype of cached volumes: float16, int16 or float32')
+    parser.add_argument('--device-augment', action='store_true', help='apply random zoom and cutout batch-wise on the training device')
 
     opt = parser.parse_known_args()[0] if known else parser.parse_args()
     return opt
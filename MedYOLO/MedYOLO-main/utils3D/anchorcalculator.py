@@ -3,11 +3,12 @@ Analyzes a YOLO3D Training dataset's labels and attempts to calculate ideal init
 """
 
 # standard library imports
+import math
 import torch
 import numpy as np
 import yaml
 from tqdm import tqdm
-import random
+from multiprocessing.pool import Pool
 from scipy.cluster.vq import kmeans
 import sys
 from pathlib import Path
@@ -30,8 +31,18 @@ from utils3D.datasets import LoadNiftisAndLabels, nifti_dataloader
 default_size = 350 # edge length for testing
 
 
-def AnchorCalculator(dataset, model, imgsz=default_size, thr=4.0, gen=1000, opt_hypers=False):
+def kmeans_distance(args):
+    """Mean kmeans distance for one number of anchors, pool worker of optimize_hypers."""
+    norm_dwh, n, seed = args
+    return kmeans(norm_dwh, n, iter=30, seed=seed)[1]  # mean distance
+
+
+def AnchorCalculator(dataset, model, imgsz=default_size, thr=4.0, gen=1000, opt_hypers=False, pop=1, seed=0, workers=1):
     # Calculate best anchors for a YOLO3D model using a dataset's training labels.
+    # Every generation scores pop mutations of the best anchors in one vectorized fitness call.  gen counts candidate
+    # anchor sets, so ceil(gen / pop) generations are run: pop > 1 batches the fitness calls but takes fewer hill
+    # climbing steps for the same number of evaluations.  kmeans and mutations are seeded so results are reproducible,
+    # workers > 1 parallelizes optimize_hypers.
     thr = 1. / thr
     prefix = 'AnchorCalculator: '
 
@@ -55,9 +66,12 @@ def AnchorCalculator(dataset, model, imgsz=default_size, thr=4.0, gen=1000, opt_
         best_x = x.max(1)[0]
         return x, best_x
 
-    def anchor_fitness(k):  # mutation fitness
-        _, best = metric(torch.tensor(k, dtype=torch.float32), dwh)
-        return (best * (best > thr).float()).mean() # fitness
+    def population_fitness(kp):  # mutation fitness of a population of anchor sets, shape [pop, num_anchors, 3]
+        # same as metric for every anchor set at once, computed in log space: min(r, 1/r) == exp(-|log(r)|)
+        # d has shape [pop, num_labels, num_anchors] before the reduction over anchors
+        d = (log_dwh[None, :, None] - torch.tensor(kp, dtype=torch.float32).log()[:, None]).abs_().amax(3).amin(2)
+        best = torch.exp(-d)
+        return (best * (best > thr).float()).mean(1)  # fitness
     
     def print_results(k):
         k = k[np.argsort(k.prod(1))] # sort small to large
@@ -76,10 +90,12 @@ def AnchorCalculator(dataset, model, imgsz=default_size, thr=4.0, gen=1000, opt_
         
         s = dwh.std(0)  # sigmas for whitening
         norm_dwh = dwh / s
-        dist_list = []
-        for i in range(1, max_anch):
-            k, dist = kmeans(norm_dwh, i, iter=30)  # points, mean distance
-            dist_list.append(dist)
+        jobs = [(norm_dwh, i, seed + i) for i in range(1, max_anch)]
+        if workers > 1:
+            with Pool(workers) as pool:
+                dist_list = pool.map(kmeans_distance, jobs)
+        else:
+            dist_list = [kmeans_distance(job) for job in jobs]
         
         plt.figure(figsize=(10,6))
         plt.plot(range(1, max_anch), dist_list, color='blue', linestyle='dashed')
@@ -115,11 +131,12 @@ def AnchorCalculator(dataset, model, imgsz=default_size, thr=4.0, gen=1000, opt_
     # Kmeans calculation
     print(f'{prefix}Running kmeans for {na} anchors on {len(dwh)} points...')
     s = dwh.std(0)  # sigmas for whitening
-    k, _ = kmeans(dwh / s, na, iter=30)  # points, mean distance
+    k, _ = kmeans(dwh / s, na, iter=30, seed=seed)  # points, mean distance
     
     assert len(k) == na, f'{prefix}ERROR: scipy.cluster.vq.kmeans requested {na} points but returned only {len(k)}'
     k *= s
     dwh = torch.tensor(dwh, dtype=torch.float32)  # filtered
+    log_dwh = dwh.log()
     dwh0 = torch.tensor(dwh0, dtype=torch.float32)  # unfiltered
     
     # Reference pre-evolution calculated anchors
@@ -127,17 +144,21 @@ def AnchorCalculator(dataset, model, imgsz=default_size, thr=4.0, gen=1000, opt_
     k = print_results(k)
 
     # Evolve anchors
-    npr = np.random
-    f, sh, mp, s = anchor_fitness(k), k.shape, 0.9, 0.1  # fitness, generations, mutation prob, sigma
-    pbar = tqdm(range(gen), desc=f'\n{prefix}Evolving anchors with Genetic Algorithm:')  # progress bar
+    npr = np.random.default_rng(seed)
+    f, sh, mp, s = population_fitness(k[None])[0], (pop, *k.shape), 0.9, 0.1  # fitness, population shape, mutation prob, sigma
+    pbar = tqdm(range(math.ceil(gen / pop)), desc=f'\n{prefix}Evolving anchors with Genetic Algorithm:')  # progress bar
     for _ in pbar:
         v = np.ones(sh)
-        while (v == 1).all():  # mutate until a change occurs (prevent duplicates)
-            v = ((npr.random(sh) < mp) * random.random() * npr.randn(*sh) * s + 1).clip(0.3, 3.0)
-        kg = (k.copy() * v).clip(min=2.0)
-        fg = anchor_fitness(kg)
-        if fg > f:
-            f, k = fg, kg.copy()
+        unchanged = np.ones(pop, dtype=bool)
+        while unchanged.any():  # mutate until a change occurs (prevent duplicates)
+            n = unchanged.sum()
+            v[unchanged] = ((npr.random((n, *sh[1:])) < mp) * npr.random((n, 1, 1)) * npr.standard_normal((n, *sh[1:])) * s + 1).clip(0.3, 3.0)
+            unchanged = (v == 1).all((1, 2))
+        kg = (k[None] * v).clip(min=2.0)
+        fg = population_fitness(kg)
+        i = int(fg.argmax())
+        if fg[i] > f:
+            f, k = fg[i], kg[i].copy()
             pbar.desc = f'{prefix}Evolving anchors with Genetic Algorithm: fitness = {f:.4f}'
     
     # Reference post-evolution calculated anchors
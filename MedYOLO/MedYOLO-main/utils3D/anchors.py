@@ -20,14 +20,45 @@ from utils3D.datasets import LoadNiftisAndLabels
 default_size = 350 # edge length for testing
 
 
-def nifti_check_anchors(dataset, model, thr=4.0, imgsz=default_size):
+def label_dwh(labels, sizes, max_labels=None, seed=0):
+    """Gathers label box sizes in voxels from the cached label arrays, without loading any images.
+    Optionally draws a class-stratified subsample of the boxes so large datasets stay cheap to analyze.
+
+    Args:
+        labels (List[np.ndarray]): per image labels in [cls, z, x, y, d, w, h] format, normalized, as in dataset.labels
+        sizes (np.ndarray): (n, 3) per image edge lengths in voxels the normalized labels are scaled by
+        max_labels (int, optional): number of boxes sampled if the dataset has more, split across classes in
+            proportion to their frequency with at least one box per class. Defaults to None (all boxes).
+        seed (int, optional): seed for the subsample. Defaults to 0.
+
+    Returns:
+        dwh (np.ndarray): (m, 3) box sizes in voxels
+    """
+    counts = [len(l) for l in labels]
+    if not sum(counts):
+        return np.zeros((0, 3))
+    l = np.concatenate(labels, 0)
+    dwh = l[:, 4:7] * np.repeat(sizes, counts, 0)  # convert dwh from proportion to voxel values
+
+    if max_labels and len(dwh) > max_labels:
+        rng = np.random.default_rng(seed)
+        classes, inverse, nc = np.unique(l[:, 0], return_inverse=True, return_counts=True)
+        nk = np.maximum(np.round(nc * max_labels / len(dwh)), 1).astype(int)  # samples per class, keep rare classes
+        i = np.concatenate([rng.choice(np.flatnonzero(inverse == c), k, replace=False) for c, k in enumerate(nk)])
+        dwh = dwh[np.sort(i)]
+    return dwh
+
+
+def nifti_check_anchors(dataset, model, thr=4.0, imgsz=default_size, max_labels=None):
     """Checks anchor fit to data and recomputes if necessary.
+    Only the cached labels and image shapes of the dataset are used, no images are read.
 
     Args:
         dataset (torch.Dataset): Dataset the anchors will be used with.
         model (torch.Module): Model that will be trained with the anchors
         thr (float, optional): Threshold of ratio between anchors and labels for a given anchor to be considered valid. Defaults to 4.0.
         imgsz (int, optional): Image size used during the training process. Defaults to default_size.
+        max_labels (int, optional): maximum number of label boxes analyzed, see label_dwh. Defaults to None (all boxes).
 
     """
     prefix = 'autoanchor: '
@@ -37,7 +68,7 @@ def nifti_check_anchors(dataset, model, thr=4.0, imgsz=default_size):
     # converting to pixel widths instead of fractional width using dimensions of resized images
     shapes = imgsz * dataset.shapes / dataset.shapes.max(1, keepdims=True)
     scale = np.random.uniform(0.9, 1.1, size=(dataset.shapes.shape[0],1))  # augment scale
-    dwh = torch.tensor(np.concatenate([l[:, 4:7] * s for s, l in zip(shapes * scale, dataset.labels)])).float()  # convert dwh from proportion to voxel values
+    dwh = torch.tensor(label_dwh(dataset.labels, shapes * scale, max_labels)).float()
 
     def metric(k):  # compute metrics for anchors
         r = dwh[:, None] / k[None]
@@ -47,8 +78,8 @@ def nifti_check_anchors(dataset, model, thr=4.0, imgsz=default_size):
         bpr = (best > 1. / thr).float().mean()  # best possible recall
         return bpr, aat
 
-    anchors = m.anchors.clone() * m.stride.to(m.anchors.device).view(-1, 1, 1)  # current anchors
-    bpr, aat = metric(anchors.cpu().view(-1, 3))
+    anchors = (m.anchors.clone() * m.stride.to(m.anchors.device).view(-1, 1, 1)).cpu().view(-1, 3)  # current anchors
+    bpr, aat = metric(anchors)
     print(f'anchors/target = {aat:.2f}, Best Possible Recall (BPR) = {bpr:.4f}', end='')
 
     # Recompute the anchors if the metric is too low
@@ -56,10 +87,11 @@ def nifti_check_anchors(dataset, model, thr=4.0, imgsz=default_size):
         print('. Attempting to improve anchors, please wait...')
         na = m.anchors.numel() // 3  # number of anchors
         try:
-            anchors = nifti_kmean_anchors(dataset, n=na, img_size=imgsz, thr=thr, gen=1000, verbose=False)
+            anchors = nifti_kmean_anchors(dataset, n=na, img_size=imgsz, thr=thr, gen=1000, verbose=False,
+                                          max_labels=max_labels)
         except Exception as e:
             print(f'{prefix}ERROR: {e}')
-        new_bpr = metric(anchors)[0]
+        new_bpr = metric(torch.as_tensor(anchors, dtype=torch.float32))[0]
         if new_bpr > bpr:  # replace anchors
             anchors = torch.tensor(anchors, device=m.anchors.device).type_as(m.anchors)
             m.anchors[:] = anchors.clone().view_as(m.anchors) / m.stride.to(m.anchors.device).view(-1, 1, 1)  # loss
@@ -70,8 +102,10 @@ def nifti_check_anchors(dataset, model, thr=4.0, imgsz=default_size):
     print('')  # newline
 
 
-def nifti_kmean_anchors(dataset='./data/Test.yaml', n=9, img_size=default_size, thr=4.0, gen=1000, verbose=True):
+def nifti_kmean_anchors(dataset='./data/Test.yaml', n=9, img_size=default_size, thr=4.0, gen=1000, verbose=True,
+                        max_labels=None, seed=0):
     """ Creates kmeans-evolved anchors from training dataset using niftis
+            Only the cached labels and image shapes are used, images are not read.
 
             Arguments:
                 dataset (str or torch.Dataset): path to data.yaml, or a loaded dataset
@@ -80,6 +114,8 @@ def nifti_kmean_anchors(dataset='./data/Test.yaml', n=9, img_size=default_size,
                 thr (float): anchor-label wh ratio threshold hyperparameter hyp['anchor_t'] used for training, default=4.0
                 gen (int): generations to evolve anchors using genetic algorithm
                 verbose (bool): print all results
+                max_labels (int): maximum number of label boxes used, class-stratified subsample, None for all boxes
+                seed (int): seed for the label subsample
 
             Return:
                 k (List[float]): kmeans evolved anchors
@@ -116,11 +152,11 @@ def nifti_kmean_anchors(dataset='./data/Test.yaml', n=9, img_size=default_size,
     if isinstance(dataset, str):  # *.yaml file
         with open(dataset, errors='ignore') as f:
             data_dict = yaml.safe_load(f)  # model dict
-        dataset = LoadNiftisAndLabels(data_dict['train'], augment=False)
+        dataset = LoadNiftisAndLabels(data_dict['train'], augment=False, check_images=False)  # header-only label cache
 
     # converting to pixel widths instead of fractional width using dimensions of resized images
     shapes = img_size * dataset.shapes / dataset.shapes
-    dwh0 = np.concatenate([l[:,4:7] * s for s, l in zip(shapes, dataset.labels)]) # dwh
+    dwh0 = label_dwh(dataset.labels, shapes, max_labels, seed)  # dwh
 
     # Filter very small objects
     size_thresh = 4.0
@@ -7,12 +7,13 @@ Augmentations used by 3D YOLO
 import random
 import numpy as np
 import torch
+import torch.nn.functional as F
 from typing import List
 
 # 2D YOLO imports
 
 # 3D YOLO imports
-from utils3D.lossandmetrics import bbox_iov
+from utils3D.general import zxydwhn2zxyzxy
 
 
 def tensor_cutout(im: torch.Tensor, labels, cutout_params: List[List[float]], p=0.5):
@@ -20,44 +21,31 @@ def tensor_cutout(im: torch.Tensor, labels, cutout_params: List[List[float]], p=
 
     Args:
         im (torch.Tensor): 3-D tensor to be augmented.
-        labels (List[float]): Med YOLO labels corresponding to im. class z1 x1 y1 z2 x2 y2
+        labels (np.ndarray): Med YOLO labels corresponding to im. class z x y d w h, normalized
         cutout_params (List[List[float]]): a list of ordered pairs that set sizes and numbers of cutout boxes.
                                            the maximum extent of the boxes is set by the first element of the ordered pair
                                            the number of boxes with that maximum extent is set by the second element of the ordered pair
         p (float, optional): probability of performing cutout augmentation. Defaults to 0.5.
 
     Returns:
-        _type_: _description_
+        im (torch.Tensor): Augmented tensor.
+        labels (np.ndarray): labels that are obscured by at most 60%.
     """
     if random.random() < p:
         d, h, w = im.shape[1:]
-        scales = []
-        for param_pair in cutout_params:
-            scales = scales + [param_pair[0]]*param_pair[1]
-       
-        for s in scales:
-            mask_d = random.randint(1, int(d * s))  # create random masks
-            mask_h = random.randint(1, int(h * s))
-            mask_w = random.randint(1, int(w * s))
-            
-            # box
-            zmin = max(0, random.randint(0, d) - mask_d // 2)
-            xmin = max(0, random.randint(0, w) - mask_w // 2)
-            ymin = max(0, random.randint(0, h) - mask_h // 2)
-            zmax = min(d, zmin + mask_d)
-            xmax = min(w, xmin + mask_w)
-            ymax = min(h, ymin + mask_h)
-            
-            # apply random greyscale mask
-            # images scaled between 0 and 1 after being returned by the dataset
-            im[:,zmin:zmax, ymin:ymax, xmin:xmax] = random.uniform(torch.min(im), torch.max(im))
-            
-            # remove obscured labels
-            if len(labels) and s > 0.03:
-                box = np.array([zmin, xmin, ymin, zmax, xmax, ymax], dtype=np.float32)
-                iov = bbox_iov(box, labels[:, 1:7])  # intersection over volume
-                labels = labels[iov < 0.60]  # remove >60% obscured labels
-                
+
+        # all boxes at once, each filled with its own random greyscale value
+        # images scaled between 0 and 1 after being returned by the dataset
+        boxes, scales = cutout_boxes(1, (d, h, w), cutout_params)
+        values = torch.min(im) + torch.rand(boxes.shape[:2]) * (torch.max(im) - torch.min(im))
+        im = fill_cutouts(im[None], boxes, values)[0]
+
+        # remove obscured labels
+        if len(labels):
+            label_boxes = torch.from_numpy(zxydwhn2zxyzxy(labels[:, 1:7], d, w, h)).float()  # pixel zxyzxy
+            iov = cutout_label_iov(label_boxes, boxes.expand(len(labels), -1, -1))  # intersection over volume
+            labels = labels[~((iov >= 0.60) & (scales > 0.03)).any(1).numpy()]  # remove >60% obscured labels
+
     return im, labels
 
 
@@ -170,3 +158,155 @@ def random_zoom(im: torch.Tensor, labels, max_zoom=1.5, min_zoom=0.7, p=0.5):
             y[:, 6] = y[:, 6] + ymin
 
     return im, y
+
+
+def cutout_boxes(n: int, shape, cutout_params: List[List[float]], device=None):
+    """Draws the cutout boxes of tensor_cutout for n volumes at once, sizes and positions are drawn per volume.
+
+    Args:
+        n (int): number of volumes.
+        shape (Tuple[int]): (depth, height, width) of the volumes.
+        cutout_params (List[List[float]]): pairs of maximum box extent and number of boxes, see tensor_cutout.
+        device (torch.device, optional): device to create the boxes on. Defaults to None.
+
+    Returns:
+        boxes (torch.Tensor): (n, k, 6) integer valued boxes in pixel z1 x1 y1 z2 x2 y2 format, x along width.
+        scales (torch.Tensor): (k) maximum extent of each box.
+    """
+    scales = torch.tensor([s for s, k in cutout_params for _ in range(int(k))], device=device, dtype=torch.float32)
+    size = torch.tensor([shape[0], shape[2], shape[1]], device=device, dtype=torch.float32)  # z, x, y extents
+    max_ext = (size * scales[:, None]).floor().clamp(min=1)  # (k, 3) largest box edge, as random.randint(1, int(d * s))
+    ext = (torch.rand(n, len(scales), 3, device=device) * max_ext).floor() + 1
+    center = (torch.rand(n, len(scales), 3, device=device) * (size + 1)).floor()  # as random.randint(0, d)
+    lo = (center - (ext / 2).floor()).clamp(min=0)
+    hi = torch.min(lo + ext, size)
+    return torch.cat((lo, hi), 2), scales
+
+
+def fill_cutouts(ims: torch.Tensor, boxes: torch.Tensor, values: torch.Tensor):
+    """Fills cutout boxes of a batch of volumes in place, later boxes overwrite earlier ones where they overlap.
+    The boxes are written as slices, which only touches the covered voxels, a mask over the whole volume costs far more.
+
+    Args:
+        ims (torch.Tensor): (n, c, depth, height, width) volumes, modified in place.
+        boxes (torch.Tensor): (n, k, 6) integer valued boxes in pixel z1 x1 y1 z2 x2 y2 format, x along width.
+        values (torch.Tensor): (n, k) fill value of each box.
+
+    Returns:
+        ims (torch.Tensor): volumes with the cutouts applied.
+    """
+    values = values.to(ims.dtype)
+    for i, volume_boxes in enumerate(boxes.long().tolist()):  # one transfer of all box coordinates
+        for k, (z1, x1, y1, z2, x2, y2) in enumerate(volume_boxes):
+            ims[i, :, z1:z2, y1:y2, x1:x2] = values[i, k]
+    return ims
+
+
+def cutout_label_iov(labels: torch.Tensor, boxes: torch.Tensor, eps=1E-7):
+    """Intersection over label volume of every label with every cutout box of its volume.
+
+    Args:
+        labels (torch.Tensor): (m, 6) labels in pixel z1 x1 y1 z2 x2 y2 format.
+        boxes (torch.Tensor): (m, k, 6) cutout boxes of the volume each label belongs to, same format.
+
+    Returns:
+        iov (torch.Tensor): (m, k) intersection over label volume.
+    """
+    inter = (torch.min(labels[:, None, 3:], boxes[..., 3:]) - torch.max(labels[:, None, :3], boxes[..., :3])).clamp(0).prod(2)
+    vol = (labels[:, 3:] - labels[:, :3]).prod(1, keepdim=True) + eps
+    return inter / vol
+
+
+def batch_tensor_cutout(ims: torch.Tensor, targets: torch.Tensor, cutout_params: List[List[float]], p=0.5):
+    """Batch version of tensor_cutout that runs on the training device, whether to cut out and the boxes are drawn per volume.
+
+    Args:
+        ims (torch.Tensor): (n, 1, depth, height, width) batch of volumes.
+        targets (torch.Tensor): (m, 8) targets as returned by the dataloader, image class z x y d w h normalized.
+        cutout_params (List[List[float]]): pairs of maximum box extent and number of boxes, see tensor_cutout.
+        p (float, optional): probability of performing cutout augmentation on a volume. Defaults to 0.5.
+
+    Returns:
+        ims (torch.Tensor): augmented volumes.
+        targets (torch.Tensor): targets without the labels that are obscured by more than 60%.
+    """
+    n, device = ims.shape[0], ims.device
+    apply = torch.rand(n, device=device) < p
+    if not apply.any():
+        return ims, targets
+
+    d, h, w = ims.shape[2:]
+    boxes, scales = cutout_boxes(int(apply.sum()), (d, h, w), cutout_params, device)
+    lo, hi = ims[apply].flatten(1).aminmax(dim=1)
+    values = lo[:, None] + torch.rand(boxes.shape[:2], device=device) * (hi - lo)[:, None]  # random greyscale per box
+    ims[apply] = fill_cutouts(ims[apply], boxes, values)
+
+    # remove obscured labels
+    if len(targets):
+        t = targets.to(device)
+        slot = torch.cumsum(apply, 0) - 1  # row of each volume in boxes
+        j = t[:, 0].long()
+        gain = torch.tensor([d, w, h, d, w, h], device=device, dtype=t.dtype)
+        labels = torch.cat((t[:, 2:5] - t[:, 5:8] / 2, t[:, 2:5] + t[:, 5:8] / 2), 1) * gain  # pixel zxyzxy
+        iov = cutout_label_iov(labels, boxes[slot[j].clamp(min=0)])
+        obscured = ((iov >= 0.60) & (scales > 0.03)).any(1) & apply[j]  # remove >60% obscured labels
+        targets = targets[~obscured.to(targets.device)]
+    return ims, targets
+
+
+def batch_random_zoom(ims: torch.Tensor, targets: torch.Tensor, max_zoom=1.5, min_zoom=0.7, p=0.5):
+    """Batch version of random_zoom that runs on the training device, whether to zoom, the zoom factor and the
+    position of the zoomed volume are drawn per volume.  Zoom, crop and padding are applied as a single trilinear
+    resampling, padding is filled with uniform noise between the minimum and maximum of the volume.
+
+    Args:
+        ims (torch.Tensor): (n, 1, depth, height, width) batch of volumes.
+        targets (torch.Tensor): (m, 8) targets as returned by the dataloader, image class z x y d w h normalized.
+        max_zoom (float, optional): maximum edge length multiplier. Defaults to 1.5.
+        min_zoom (float, optional): minimum edge length multiplier. Defaults to 0.7.
+        p (float, optional): probability of zooming a volume. Defaults to 0.5.
+
+    Returns:
+        ims (torch.Tensor): augmented volumes.
+        targets (torch.Tensor): adjusted targets.
+    """
+    n, device = ims.shape[0], ims.device
+    apply = torch.rand(n, device=device) < p
+    if not apply.any():
+        return ims, targets
+
+    # zoom factor and offset of the zoomed volume in pixels, negative when cropping a zoomed in volume
+    size = torch.tensor(ims.shape[2:], device=device, dtype=torch.float32)  # d, h, w
+    zoom = torch.empty(n, device=device).uniform_(min_zoom, max_zoom)
+    shift = (torch.rand(n, 3, device=device) * (size - (size * zoom[:, None]).floor())).floor()
+    zoom, shift = torch.where(apply, zoom, 1.), shift * apply[:, None]
+
+    # output voxel o samples the input at (o + 0.5 - shift) / zoom, in grid_sample's normalized coordinates
+    a = apply.nonzero(as_tuple=True)[0]
+    t = (1 - 2 * shift[a] / size) / zoom[a, None] - 1  # translation d, h, w
+    theta = torch.zeros(len(a), 3, 4, device=device)
+    theta[:, 0, 0] = theta[:, 1, 1] = theta[:, 2, 2] = 1 / zoom[a]
+    theta[:, :, 3] = t.flip(1)  # grid order is x (width), y (height), z (depth)
+    grid = F.affine_grid(theta, [len(a), *ims.shape[1:]], align_corners=False)
+    zoomed = F.grid_sample(ims[a].float(), grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    # fill the padding of zoomed out volumes with noise
+    outside = (grid.abs() > 1).any(-1)[:, None]
+    if outside.any():
+        lo, hi = ims[a].flatten(1).aminmax(dim=1)
+        noise = torch.rand_like(zoomed) * (hi - lo).view(-1, 1, 1, 1, 1) + lo.view(-1, 1, 1, 1, 1)
+        zoomed = torch.where(outside, noise, zoomed)
+    ims[a] = zoomed.to(ims.dtype)
+
+    # shrink/expand and move labels, then clip them to the volume
+    if len(targets):
+        y = targets.to(device).clone()
+        j = y[:, 0].long()
+        offset = (shift / size)[:, [0, 2, 1]]  # z, x, y
+        y[:, 2:5] = y[:, 2:5] * zoom[j, None] + offset[j]
+        y[:, 5:8] *= zoom[j, None]
+        lim = (1 - 1E-3 / size[[0, 2, 1, 0, 2, 1]]).to(y.dtype)  # clip like zxyzxy2zxydwhn(clip=True, eps=1E-3)
+        zxyzxy = torch.min(torch.cat((y[:, 2:5] - y[:, 5:8] / 2, y[:, 2:5] + y[:, 5:8] / 2), 1).clamp(min=0), lim)
+        y[:, 2:5], y[:, 5:8] = (zxyzxy[:, :3] + zxyzxy[:, 3:]) / 2, zxyzxy[:, 3:] - zxyzxy[:, :3]
+        targets = y.to(targets.device)
+    return ims, targets
@@ -8,7 +8,7 @@ import numpy as np
 from pathlib import Path
 import glob
 import os
-from multiprocessing.pool import Pool
+from multiprocessing.pool import Pool, ThreadPool
 from tqdm import tqdm
 from itertools import repeat
 from typing import List
@@ -88,6 +88,40 @@ class BalancedBatchSampler(torch.utils.data.Sampler):
         return len(self.neg_idx) // (self.batch_size - 1)
 
 
+class DistributedWeightedSampler(torch.utils.data.Sampler):
+    """
+    WeightedRandomSampler for DDP: every rank draws the same weighted sample with
+    replacement (seeded by seed + epoch) and keeps its own interleaved shard of it,
+    so manifest-based oversampling works the same with and without DDP.
+
+    Args:
+        weights (torch.Tensor): per image sampling weight
+        num_samples (int): total number of samples per epoch, across all ranks
+        num_replicas (int, optional): number of DDP processes. Defaults to the world size.
+        rank (int, optional): global rank of this process. Defaults to the current rank.
+        seed (int, optional): base seed, must be the same on all ranks. Defaults to 0.
+    """
+    def __init__(self, weights, num_samples: int, num_replicas=None, rank=None, seed=0):
+        self.weights      = torch.as_tensor(weights, dtype=torch.double)
+        self.num_replicas = torch.distributed.get_world_size() if num_replicas is None else num_replicas
+        self.rank         = torch.distributed.get_rank() if rank is None else rank
+        self.num_samples  = -(-num_samples // self.num_replicas)  # per rank, ceil
+        self.seed         = seed
+        self.epoch        = 0
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        idx = torch.multinomial(self.weights, self.num_samples * self.num_replicas, True, generator=g)
+        return iter(idx[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+
 def file_lister_train(parent_dir: List[str], prefix=''):
     """Takes a parent directory or list of parent directories and
     looks for files within those directories.  Output organized to fit
@@ -148,13 +182,15 @@ def file_lister_detect(parent_dir: str):
 
 class LoadNiftis(Dataset):
     """YOLO3D Pytorch Dataset for inference."""
-    def __init__(self, path: str, img_size=default_size, stride=32):
+    def __init__(self, path: str, img_size=default_size, stride=32, native=False):
         """Initialization for the inference Dataset
 
         Args:
             path (str): parent directory for the Dataset's files
             img_size (int, optional): edge length for the cube input will be reshaped to. Defaults to default_size (currently 350).
             stride (int, optional): model stride, used for resizing and augmentation, currently unimplemented. Defaults to 32.
+            native (bool, optional): __getitem__ returns the transposed volume at native resolution and its voxel spacing
+                instead of the resized cube, used for sliding-window inference. Defaults to False.
         """
         
         # Find files in the given path and filter to leave only .nii and .nii.gz files in the list
@@ -165,6 +201,7 @@ class LoadNiftis(Dataset):
         self.files = images
         self.img_size = img_size
         self.stride = stride
+        self.native = native
 
         assert self.nf > 0, f'No images found in {path}. Supported formats are: {IMG_FORMATS}'
 
@@ -191,16 +228,44 @@ class LoadNiftis(Dataset):
 
         return path, img, img0
 
+    def __getitem__(self, index):
+        """Map-style access, used by detect.py to decode and resize upcoming volumes in DataLoader worker processes.
+        Only the shape of the original volume is returned to avoid sending it between processes.
+
+        Args:
+            index (int): index of the file to load
+
+        Returns:
+            path (str): path to the nifti
+            img (torch.tensor): resized model input, or the (depth, height, width) volume at native resolution if self.native
+            shape0 (torch.Size): shape of the original volume, or the (depth, height, width) voxel spacing if self.native
+        """
+        path = self.files[index]
+        img0, affine = open_nifti(path)
+        assert img0 is not None, 'Image Not Found ' + path
+        if self.native:
+            zooms = nib.affines.voxel_sizes(affine)
+            return path, transpose_nifti_shape(img0), (float(zooms[2]), float(zooms[0]), float(zooms[1]))
+        img = change_nifti_size(transpose_nifti_shape(img0), self.img_size)
+        return path, img, img0.shape
+
     def __len__(self):
         return self.nf  # number of files
 
+    @staticmethod
+    def collate_fn(batch):
+        """Used to collate volumes into inference batches"""
+        path, img, shape0 = zip(*batch)  # transposed
+        return path, torch.stack(img, 0), shape0
+
 
 class LoadNiftisAndLabels(Dataset):
     """YOLO3D Pytorch Dataset for training."""
-    cache_version = 0.61  # dataset labels *.cache version
+    cache_version = 0.62  # dataset labels *.cache version
 
     def __init__(self, path, img_size=default_size, batch_size=4, augment=False, hyp=None, single_cls=False,
-                 stride=32, pad=0.0, prefix=''):
+                 stride=32, pad=0.0, prefix='', sample_weights=None, check_images=False, cache_images=None,
+                 cache_dtype='float16', device_augment=False):
         """Initialization for the training Dataset
 
         Args:
@@ -212,6 +277,14 @@ class LoadNiftisAndLabels(Dataset):
             stride (int, optional): model stride, used for resizing and augmentation, currently unimplemented. Defaults to 32.
             pad (float, optional): image padding, used for resizing and augmentation, currently unimplemented. Defaults to 0.0.
             prefix (str, optional): Prefix for error messages. Defaults to ''.
+            sample_weights (str, optional): path to a sampling weight manifest, see load_sample_weights. Defaults to None.
+            check_images (bool, optional): fully decompress every image when building the label cache to detect
+                corrupt files, otherwise only the NIfTI headers are read. Defaults to False.
+            cache_images (str, optional): cache the preprocessed (transposed and resized) volumes in 'ram' or on 'disk'
+                as memory-mapped .npy files, see cache_volumes. Defaults to None (no caching).
+            cache_dtype (str, optional): dtype of the cached volumes, 'float16', 'int16' or 'float32'. Defaults to 'float16'.
+            device_augment (bool, optional): leave random zoom and cutout to the training loop, which applies them
+                batch-wise on the training device with batch_random_zoom and batch_tensor_cutout. Defaults to False.
 
         Raises:
             Exception: if unable to load data in given path.
@@ -220,7 +293,9 @@ class LoadNiftisAndLabels(Dataset):
         self.stride = stride
         self.path = path
         self.augment = augment
+        self.device_augment = device_augment
         self.hyp = hyp
+        self.check_images = check_images
 
         # Find files in the given path and filter to leave only .nii and .nii.gz files in the list
         try:
@@ -237,6 +312,7 @@ class LoadNiftisAndLabels(Dataset):
             cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
             assert cache['version'] == self.cache_version  # same version
             assert cache['hash'] == get_hash(self.label_files + self.img_files)  # same hash
+            assert cache['check_images'] or not check_images  # header-only caches are rebuilt on request
         except:
             cache, exists = self.cache_labels(cache_path, prefix), False  # cache
 
@@ -250,7 +326,7 @@ class LoadNiftisAndLabels(Dataset):
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels.'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
+        [cache.pop(k) for k in ('hash', 'version', 'msgs', 'check_images')]  # remove items
         labels, shapes, self.segments = zip(*cache.values())
         self.labels = list(labels)
         self.shapes = np.array(shapes, dtype=np.float64)
@@ -274,6 +350,11 @@ class LoadNiftisAndLabels(Dataset):
                 self.labels[i][:, 0] = 0
 
         self.imgs, self.img_npy = [None] * n, [None] * n
+        if cache_images:
+            self.cache_volumes(cache_images, cache_dtype, cache_path, prefix)
+
+        # Oversampling weights, used by nifti_dataloader instead of physically duplicated files
+        self.sample_weights = load_sample_weights(sample_weights, self.img_files) if sample_weights else None
 
     def cache_labels(self, path=Path('./labels.cache'), prefix=''):
         """Caches dataset labels, verifies images and reads their shapes.
@@ -290,7 +371,7 @@ class LoadNiftisAndLabels(Dataset):
         nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
         desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
         with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.img_files, self.label_files, repeat(prefix))),
+            pbar = tqdm(pool.imap(verify_image_label, zip(self.img_files, self.label_files, repeat(prefix), repeat(self.check_images))),
                         desc=desc, total=len(self.img_files))
             for im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
                 nm += nm_f
@@ -308,6 +389,7 @@ class LoadNiftisAndLabels(Dataset):
         x['results'] = nf, nm, ne, nc, len(self.img_files)
         x['msgs'] = msgs  # warnings
         x['version'] = self.cache_version  # cache version
+        x['check_images'] = self.check_images  # whether images were fully decompressed during verification
         try:
             np.save(path, x)  # save cache for next time
             path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
@@ -315,8 +397,57 @@ class LoadNiftisAndLabels(Dataset):
             print(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')
         return x
 
+    def cache_volumes(self, cache_images, cache_dtype, cache_path, prefix=''):
+        """Preprocesses every volume once (transpose and resize to self.img_size) and keeps it in a compact dtype,
+        either in RAM (self.imgs) or on disk as .npy files that are memory-mapped on access (self.img_npy).
+        Disk cache files are keyed on the image path and size (as in get_hash), img_size and dtype,
+        so changed images are preprocessed again.
+
+        Args:
+            cache_images (str): 'ram' or 'disk'
+            cache_dtype (str): 'float16', 'int16' or 'float32'
+            cache_path (pathlib.Path): path of the label cache, the disk cache is stored next to it
+            prefix (str, optional): Prefix for messages. Defaults to ''.
+        """
+        assert cache_images in ('ram', 'disk'), f'{prefix}invalid cache_images {cache_images}, use ram or disk'
+        assert cache_dtype in ('float16', 'int16', 'float32'), f'{prefix}invalid cache_dtype {cache_dtype}'
+        self.cache_dtype = np.dtype(cache_dtype)
+        if cache_images == 'disk':
+            npy_dir = cache_path.parent / (cache_path.stem + '_npy')
+            npy_dir.mkdir(parents=True, exist_ok=True)
+            self.img_npy = [npy_dir / f"{Path(f).name.split('.')[0]}_{get_hash([f, str(self.img_size), cache_dtype])[:12]}.npy"
+                            for f in self.img_files]
+
+        def cache_one(i):
+            if cache_images == 'disk':
+                if not self.img_npy[i].exists():
+                    tmp = self.img_npy[i].with_suffix(f'.{os.getpid()}.tmp.npy')
+                    np.save(tmp, self.preprocess_volume(i))
+                    tmp.rename(self.img_npy[i])
+                return self.img_npy[i].stat().st_size
+            self.imgs[i] = self.preprocess_volume(i)
+            return self.imgs[i].nbytes
+
+        gb = 0  # cache size (GB)
+        with ThreadPool(NUM_THREADS) as pool:
+            pbar = tqdm(pool.imap(cache_one, range(self.n)), total=self.n)
+            for nbytes in pbar:
+                gb += nbytes
+                pbar.desc = f'{prefix}Caching volumes ({gb / 1E9:.1f}GB {cache_images})'
+        pbar.close()
+
+    def preprocess_volume(self, i):
+        """Loads volume i, transposes and resizes it as load_nifti does and converts it to self.cache_dtype."""
+        im, _ = open_nifti(self.img_files[i])
+        im = change_nifti_size(transpose_nifti_shape(im), self.img_size).numpy()
+        if self.cache_dtype.kind == 'i':
+            info = np.iinfo(self.cache_dtype)
+            im = np.clip(np.rint(im), info.min, info.max)
+        return im.astype(self.cache_dtype)
+
     def load_nifti(self, i):
         """Reads a nifti file, converts it to a torch.tensor, and reshapes and resizes it for use in the YOLO3D model.
+        Volumes cached by cache_volumes are read from RAM or the memory-mapped .npy file instead.
 
         Args:
             i (int): Dataset index for the nifti to be loaded
@@ -330,6 +461,12 @@ class LoadNiftisAndLabels(Dataset):
         """
         # loads 1 image from dataset index 'i'
         path = self.img_files[i]
+        if self.imgs[i] is not None or self.img_npy[i] is not None:
+            im = self.imgs[i] if self.imgs[i] is not None else np.load(self.img_npy[i], mmap_mode='r')
+            im = torch.from_numpy(im.astype(np.float32))
+            d0, h0, w0 = (int(x) for x in self.shapes[i])
+            return im, (d0, h0, w0), im.size()[1:], nib.load(path).affine  # affine from the header only
+
         im, affine = open_nifti(path)
 
         # reshape im from height, width, depth to depth, height, width to make it compatible with torch convolutions
@@ -370,7 +507,7 @@ class LoadNiftisAndLabels(Dataset):
         labels = self.labels[self.indices[index]].copy()
 
         nl = len(labels)  # number of labels
-        if self.augment:           
+        if self.augment and not self.device_augment:           
             # Label transformation is done to make certain augmentations more straightforward
             if labels.size:  # normalized zxydwh to pixel zxyzxy format
                 labels[:, 1:] = zxydwhn2zxyzxy(labels[:, 1:], d, w, h, pad[0], pad[1], pad[2])                    
@@ -456,9 +593,12 @@ class LoadNiftisAndLabels(Dataset):
 #     return dataloader, dataset
 
 def nifti_dataloader(path: str, imgsz: int, batch_size: int, stride: int, single_cls=False, hyp=None, augment=False, pad=0.0,
-                     rank=-1, workers=8, prefix=''):
+                     rank=-1, workers=8, prefix='', sample_weights=None, check_images=False, cache_images=None,
+                     cache_dtype='float16', device_augment=False):
     """This is the dataloader used in the training process
-    The same as that of 2D YOLO, just built around a different Dataset definition
+    The same as that of 2D YOLO, just built around a different Dataset definition.
+    If sample_weights is given, images are drawn with replacement proportionally to their weight,
+    with an epoch length equal to the sum of the weights, sharded across ranks under DDP.
 
     Args:
         path (str): path to the directory containing the training files
@@ -471,6 +611,11 @@ def nifti_dataloader(path: str, imgsz: int, batch_size: int, stride: int, single
         rank (int, optional): determines whether to use distributed sampling. Defaults to -1.
         workers (int, optional): number of dataloader workers. Defaults to 8.
         prefix (str, optional): Prefix for error messages. Defaults to ''.
+        sample_weights (str, optional): path to a sampling weight manifest, see load_sample_weights. Defaults to None.
+        check_images (bool, optional): fully decompress images when building the label cache. Defaults to False.
+        cache_images (str, optional): cache preprocessed volumes in 'ram' or on 'disk'. Defaults to None.
+        cache_dtype (str, optional): dtype of the cached volumes. Defaults to 'float16'.
+        device_augment (bool, optional): skip random zoom and cutout in the workers, see LoadNiftisAndLabels. Defaults to False.
 
     Returns:
         dataloader: dataloader for training loop
@@ -485,10 +630,22 @@ def nifti_dataloader(path: str, imgsz: int, batch_size: int, stride: int, single
                                       single_cls=single_cls,
                                       stride=stride,
                                       pad=pad,
-                                      prefix=prefix)
+                                      prefix=prefix,
+                                      sample_weights=sample_weights,
+                                      check_images=check_images,
+                                      cache_images=cache_images,
+                                      cache_dtype=cache_dtype,
+                                      device_augment=device_augment)
     if 'val' in path and not augment:          # simple heuristic: val loader gets balanced sampler
         sampler = BalancedBatchSampler(dataset, batch_size)
         shuffle = False
+    elif dataset.sample_weights is not None:  # manifest-based oversampling
+        weights, num_samples = torch.from_numpy(dataset.sample_weights), int(round(dataset.sample_weights.sum()))
+        if rank == -1:
+            sampler = torch.utils.data.WeightedRandomSampler(weights, num_samples=num_samples, replacement=True)
+        else:
+            sampler = DistributedWeightedSampler(weights, num_samples=num_samples)
+        shuffle = False
     else:                                      # training loader keeps current behaviour
         sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
         shuffle = sampler is None
@@ -505,6 +662,22 @@ def nifti_dataloader(path: str, imgsz: int, batch_size: int, stride: int, single
     return dataloader, dataset
 
 
+def load_sample_weights(manifest_path: str, img_files: List[str]):
+    """Reads a sampling weight manifest with one '<image file name> <weight>' pair per line,
+    as written by data_prep/upsample_split.py.  Images not listed get weight 1.
+
+    Args:
+        manifest_path (str): path to the manifest file.
+        img_files (List[str]): image paths of the dataset, matched to the manifest by file name.
+
+    Returns:
+        weights (np.ndarray): sampling weight for each image in img_files.
+    """
+    with open(manifest_path) as f:
+        weights = {name: float(w) for name, w in (line.split() for line in f if line.strip())}
+    return np.array([weights.get(os.path.basename(x), 1.0) for x in img_files], dtype=np.float64)
+
+
 def img2label_paths(img_paths):
     """Defines label paths as a function of the image paths.  Filters for .nii and .nii.gz files.
 
@@ -529,9 +702,10 @@ def img2label_paths(img_paths):
 
 def verify_image_label(args):
     """Verify one image-label pair.  Works for .nii and .nii.gz files.
+    The image shape is read from the NIfTI header, the image data is only decompressed if check_images is set.
 
     Args:
-        args (Tuple[str]): contains the image path, label path, and error message prefix
+        args (Tuple[str]): contains the image path, label path, error message prefix, and check_images flag
 
     Returns:
         im_file (str): path to the image file
@@ -544,11 +718,13 @@ def verify_image_label(args):
         nc (int): 1 if label corrupted and Exception found, 0 if not
         msg (str): Message returned in the event an error occurs
     """
-    im_file, lb_file, prefix = args
+    im_file, lb_file, prefix, check_images = args
     nm, nf, ne, nc, msg, segments = 0, 0, 0, 0, '', []  # number (missing, found, empty, corrupt), message, segments
     try:
         # verify images
-        im = np.array(nib.load(im_file).dataobj)
+        im = nib.load(im_file)  # lazy, only the header is read
+        if check_images:
+            np.asanyarray(im.dataobj)  # full decompression, raises on truncated or corrupt files
         shape = (im.shape[2], im.shape[0], im.shape[1]) # need to transpose to account for depth reshaping that will happen to image tensors
         # assert call may need to be reworked for non-nifti data-types or if larger minimum sizes are required
         assert (shape[0] > 9) & (shape[1] > 99) & (shape[2] > 99), f'image size {shape} < 10x100x100 voxels'
@@ -583,7 +759,10 @@ def verify_image_label(args):
 
 
 def open_nifti(filepath: str):
-    """Reads a nifti file and converts it to a torch tensor
+    """Reads a nifti file and converts it to a torch tensor.
+    The tensor keeps the on-disk integer dtype (e.g. int16 for CT) and shares memory with the array nibabel decoded,
+    conversion to float happens once in change_nifti_size.  Scaled (scl_slope/scl_inter) and floating point niftis
+    are returned as float32.
 
     Args:
         filepath (str): Path to the nifti file
@@ -594,19 +773,26 @@ def open_nifti(filepath: str):
     """
     nifti = nib.load(filepath)
     nifti_affine = nifti.affine
-    # nifti_array = np.array(nifti.dataobj)
-    # assert nifti_array is not None, 'Image Not Found ' + filepath
-    # nifti_tensor = torch.tensor(nifti_array, dtype=torch.float)
-    # return nifti_tensor, nifti_affine
-    nifti = np.array(nifti.dataobj)
+    dataobj = nifti.dataobj
+    if getattr(dataobj, 'slope', 1.0) != 1.0 or getattr(dataobj, 'inter', 0.0) != 0.0:
+        nifti = nifti.get_fdata(dtype=np.float32)  # scaled, nibabel would otherwise return float64
+    else:
+        nifti = np.asanyarray(dataobj)  # no extra copy
     assert nifti is not None, 'Image Not Found ' + filepath
-    nifti = torch.tensor(nifti, dtype=torch.float)
+    if nifti.dtype.kind == 'f' and nifti.dtype != np.float32:
+        nifti = nifti.astype(np.float32)  # e.g. float64 on disk, keeps host memory at float32
+    elif not nifti.dtype.isnative:
+        nifti = nifti.astype(nifti.dtype.newbyteorder('='))  # torch only accepts native byte order
+    try:
+        nifti = torch.from_numpy(nifti)  # stride-aware, works on the Fortran-ordered arrays nibabel returns
+    except TypeError:
+        nifti = torch.from_numpy(nifti.astype(np.float32))  # dtypes without a torch equivalent, e.g. uint32
     return nifti, nifti_affine
 
 
 def transpose_nifti_shape(nifti_tensor: torch.Tensor):
     """Reshapes the tensor from height, width, depth order to depth, height, width
-    to make it compatible with torch convolutions.
+    to make it compatible with torch convolutions.  Returns a view, no data is copied.
 
     Args:
         nifti_tensor (torch.tensor): tensor to be reshaped
@@ -614,14 +800,12 @@ def transpose_nifti_shape(nifti_tensor: torch.Tensor):
     Returns:
         nifti_tensor (torch.tensor): reshaped tensor
     """
-    nifti_tensor = torch.transpose(nifti_tensor, 0, 2)
-    nifti_tensor = torch.transpose(nifti_tensor, 1, 2)
-    return nifti_tensor
+    return nifti_tensor.permute(2, 0, 1)
 
 
 def change_nifti_size(nifti_tensor: torch.Tensor, new_size: int):
     """Resizes a 3D tensor to a cube with edge length new_size.
-    Also adds the channel dimension.
+    Also adds the channel dimension.  Integer tensors are converted to float here.
 
     Args:
         nifti_tensor (torch.Tensor): The tensor to be resized
@@ -630,6 +814,8 @@ def change_nifti_size(nifti_tensor: torch.Tensor, new_size: int):
     Returns:
         nifti_tensor (torch.tensor): Resized, cubic tensor
     """
+    if not nifti_tensor.is_floating_point():
+        nifti_tensor = nifti_tensor.float()
     # add channel dimension for compatibility with later code
     nifti_tensor = torch.unsqueeze(nifti_tensor, 0)
     # add batch dimension for functional interpolate
@@ -144,6 +144,55 @@ def zxyzxy2zxydwh(labels):
     return y
 
 
+def label_rows(det, gn):
+    """Convert nx8 detections [z1, x1, y1, z2, x2, y2, conf, cls] of one volume to rows in the normalized
+    label format [cls, z, x, y, d, w, h, conf], all boxes at once.
+
+    Args:
+        det (torch.tensor): nx8 detections in [z1, x1, y1, z2, x2, y2, conf, cls] format
+        gn (torch.tensor): normalization gain dwhdwh
+
+    Returns:
+        rows (torch.tensor): nx8 label rows on the cpu, drop the last column for labels without confidence
+    """
+    det = det.cpu()
+    zxydwh = zxyzxy2zxydwh(det[:, :6]) / gn  # normalized zxydwh
+    return torch.cat((det[:, 7:8], zxydwh, det[:, 6:7]), 1)
+
+
+def write_label_rows(file, rows):
+    """Append label rows to a txt label file with a single write.
+
+    Args:
+        file (str or Path): txt file to append to
+        rows (torch.tensor): label rows, e.g. from label_rows
+    """
+    if len(rows):
+        with open(file, 'a') as f:
+            f.write(''.join(('%g ' * len(row)).rstrip() % tuple(row) + '\n' for row in rows.tolist()))
+
+
+def save_prediction_table(file, names, rows):
+    """Save the label rows of a whole run as one columnar file, a .csv or a structured .npy array depending on the suffix.
+
+    Args:
+        file (str or Path): output file, .csv or .npy
+        names (List[str]): source file name of every row
+        rows (np.ndarray): nx8 label rows in [cls, z, x, y, d, w, h, conf] format
+    """
+    columns = ['cls', 'z', 'x', 'y', 'd', 'w', 'h', 'conf']
+    if Path(file).suffix == '.npy':
+        table = np.zeros(len(rows), dtype=[('file', f'U{max(map(len, names), default=1)}')] + [(c, 'f4') for c in columns])
+        table['file'] = names
+        for k, c in enumerate(columns):
+            table[c] = rows[:, k]
+        np.save(file, table)
+    else:
+        with open(file, 'w') as f:
+            f.write(','.join(['file'] + columns) + '\n')
+            f.write(''.join(f'{name},' + ','.join('%g' % v for v in row) + '\n' for name, row in zip(names, rows.tolist())))
+
+
 def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     """Rescale bounding box coordinates (zxyzxy) from img1_shape to img0_shape.
 
@@ -204,6 +253,31 @@ def clip_coords(boxes, shape):
         boxes[:, [2, 5]] = boxes[:, [2, 5]].clip(0, shape[2])  # y1, y2
 
 
+_NMS_CHUNK = 128  # boxes resolved per step in _3d_nms, small chunks let kept boxes prune the remainder early
+
+
+def _3d_iou_matrix(boxes1: torch.Tensor, volumes1: torch.Tensor, boxes2: torch.Tensor, volumes2: torch.Tensor):
+    """IoU of every box in boxes1 against every box in boxes2, evaluated in the same order of operations as the
+    sequential greedy formulation so that thresholding gives identical results.
+
+    Args:
+        boxes1 (torch.Tensor): (Tensor[N, 6]) boxes in (z1, x1, y1, z2, x2, y2) format
+        volumes1 (torch.Tensor): (Tensor[N]) volumes of boxes1
+        boxes2 (torch.Tensor): (Tensor[M, 6]) boxes in (z1, x1, y1, z2, x2, y2) format
+        volumes2 (torch.Tensor): (Tensor[M]) volumes of boxes2
+
+    Returns:
+        torch.Tensor: (Tensor[N, M]) IoU matrix
+    """
+    # intersection depth * width * height, one axis at a time to keep the temporaries 2D
+    inter = None
+    for k in range(3):
+        edge = torch.min(boxes1[:, None, k + 3], boxes2[None, :, k + 3])
+        edge = edge.sub_(torch.max(boxes1[:, None, k], boxes2[None, :, k])).clamp_(min=0.0)
+        inter = edge if inter is None else inter.mul_(edge)
+    return inter / (volumes2[None] - inter).add_(volumes1[:, None])
+
+
 def _3d_nms(boxes: torch.Tensor, scores: torch.Tensor, iou_threshold: float):
     """Performs non-maximum suppression (NMS) on bounding boxes according
        to their intersection-over-union (IoU).
@@ -230,85 +304,41 @@ def _3d_nms(boxes: torch.Tensor, scores: torch.Tensor, iou_threshold: float):
     Returns:
         torch.Tensor: int64 tensor with the indices of the elements that have been kept by NMS, sorted in decreasing order of scores
     """
-    # extract coordinates for every prediction box present in boxes
-    z1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y1 = boxes[:, 2]
-    z2 = boxes[:, 3]
-    x2 = boxes[:, 4]
-    y2 = boxes[:, 5]
+    # sort the prediction boxes by descending confidence, same tie order as popping from an ascending argsort
+    order = scores.argsort().flip(0)
+    boxes = boxes[order]
 
     # calculate volume of every block in P
-    volumes = (z2 - z1) * (x2 - x1) * (y2 - y1)
-
-    # sort the prediction boxes in scores according to their confidence scores
-    order = scores.argsort()
-
-    # initialise an empty list for filtered prediction boxes
-    keep = []
-
-    while len(order) > 0:
-        # extract the index of the prediction with highest score
-        idx = order[-1]
-
-        # add that box's index to filtered predictions list
-        keep.append(idx)
-
-        # remove the box from scores
-        order = order[:-1]
-
-        # sanity check
-        if len(order) == 0:
-            break
-
-        # select coordinates of BBoxes according to the indices in order
-        zz1 = torch.index_select(z1, dim=0, index=order)
-        zz2 = torch.index_select(z2, dim=0, index=order)
-        xx1 = torch.index_select(x1, dim=0, index=order)
-        xx2 = torch.index_select(x2, dim=0, index=order)
-        yy1 = torch.index_select(y1, dim=0, index=order)
-        yy2 = torch.index_select(y2, dim=0, index=order)
-
-        # find the coordinates of the intersection boxes
-        zz1 = torch.max(zz1, z1[idx])
-        xx1 = torch.max(xx1, x1[idx])
-        yy1 = torch.max(yy1, y1[idx])
-        zz2 = torch.min(zz2, z2[idx])
-        xx2 = torch.min(xx2, x2[idx])
-        yy2 = torch.min(yy2, y2[idx])
-
-        # find height and width of the intersection boxes
-        d = zz2 - zz1
-        w = xx2 - xx1
-        h = yy2 - yy1
-
-        # clamp minimum with 0.0 to avoid negative w and h due to non-overlapping boxes
-        d = torch.clamp(d, min=0.0)
-        w = torch.clamp(w, min=0.0)
-        h = torch.clamp(h, min=0.0)
-
-        # find the intersection volume
-        inter = d * w * h
-
-        # find the volumes of BBoxes according to the indices in order
-        rem_volumes = torch.index_select(volumes, dim=0, index=order)
-
-        # find the union of every box in boxes with the box currently being tested
-        # Note that volumes[idx] represents the volume of the current box
-        union = (rem_volumes - inter) + volumes[idx]
-
-        # find the IoU of every prediction in boxes with the current box
-        IoU = inter / union
-
-        # keep the boxes with IoU less than thresh_iou
-        mask = IoU < iou_threshold
-        order = order[mask]
-
-    return torch.stack(keep, dim=0)
+    volumes = (boxes[:, 3] - boxes[:, 0]) * (boxes[:, 4] - boxes[:, 1]) * (boxes[:, 5] - boxes[:, 2])
+
+    # boxes are resolved in score-sorted chunks of the still unsuppressed boxes: greedy NMS inside a chunk is solved
+    # as a fixed point on its upper triangular IoU matrix (Cluster-NMS), then the boxes kept from the chunk suppress
+    # every lower scoring box at once, which gives exactly the boxes the sequential loop keeps
+    keep = torch.zeros(len(boxes), dtype=torch.bool, device=boxes.device)
+    remaining = torch.arange(len(boxes), device=boxes.device)
+    while len(remaining):
+        idx, remaining = remaining[:_NMS_CHUNK], remaining[_NMS_CHUNK:]
+        if len(idx) > 1:
+            iou = _3d_iou_matrix(boxes[idx], volumes[idx], boxes[idx], volumes[idx])
+            suppresses = (~(iou < iou_threshold)).triu_(diagonal=1)  # higher scoring row suppresses lower scoring column
+            chunk_keep = torch.ones(len(idx), dtype=torch.bool, device=boxes.device)
+            while True:
+                new_keep = ~(suppresses & chunk_keep[:, None]).any(0)
+                if torch.equal(new_keep, chunk_keep):
+                    break
+                chunk_keep = new_keep
+            idx = idx[chunk_keep]
+        keep[idx] = True
+
+        if len(remaining):
+            iou = _3d_iou_matrix(boxes[idx], volumes[idx], boxes[remaining], volumes[remaining])
+            remaining = remaining[(iou < iou_threshold).all(0)]
+
+    return order[keep]
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=(), max_det=300):
+                        labels=(), max_det=300, merge=False, batched=False):
     """Runs Non-Maximum Suppression (NMS) on inference results for 3D bounding box predictions.
 
     Args:
@@ -319,7 +349,9 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
         agnostic (bool, optional): Whether to use class agnostic NMS. Defaults to False.
         multi_label (bool, optional): Whether or not to allow multiple labels per box. Defaults to False.
         labels (tuple, optional): Labels to use if autolabelling. Defaults to ().
-        max_det (int, optional): Maximum number of detections to allow. Defaults to 300.
+        max_det (int, optional): Maximum number of detections to allow per image. Defaults to 300.
+        merge (bool, optional): Whether to replace every kept box by the confidence weighted mean of the boxes it suppresses. Defaults to False.
+        batched (bool, optional): Whether to run one NMS call over all images and classes of the batch instead of one call per image. Defaults to False.
 
     Returns:
         output (torch.tensor): list of detections, on (n,8) tensor per image [zxyzxy, conf, cls]
@@ -335,12 +367,11 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     min_dwh, max_dwh = 4, 41943040  # (pixels) minimum and maximum box depth*width*height
     max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
     time_limit = 10.0  # seconds to quit after
-    redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
     output = [torch.zeros((0, 8), device=prediction.device)] * prediction.shape[0]
+    candidates = []  # (image index, detections) of every image, for batched NMS
     for xi, x in enumerate(prediction):  # image index, image inference
         # Apply constraints
         # x[((x[..., 3:6] < min_dwh) | (x[..., 3:6] > max_dwh)).any(1), 6] = 0  # depth-width-height
@@ -388,23 +419,64 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
         elif n > max_nms:  # excess boxes
             x = x[x[:, 6].argsort(descending=True)[:max_nms]]  # sort by confidence
 
-        # Batched NMS
-        c = x[:, 7:8] * (0 if agnostic else max_dwh)  # classes
+        if batched:
+            candidates.append((xi, x))
+            continue
+
+        # Batched NMS, classes are offset by more than the extent of all boxes, a fixed large offset costs float32 precision
+        c = x[:, 7:8] * (0 if agnostic else x[:, :6].max() - x[:, :6].min() + 1)  # classes
         boxes, scores = x[:, :6] + c, x[:, 6]  # boxes (offset by class), scores
         i = _3d_nms(boxes, scores, iou_thres)  # 3D NMS
         if i.shape[0] > max_det:  # limit detections
             i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,6) = weights(i,n) * boxes(n,6)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :6] = torch.mm(weights, x[:, :6]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
+        if merge:  # Merge NMS (boxes merged using weighted mean)
+            x[i, :6] = merge_boxes(x[:, :6], boxes, scores, i, iou_thres)
 
         output[xi] = x[i]
         if (time.time() - t) > time_limit:
             print(f'WARNING: NMS time limit {time_limit}s exceeded')
             break  # time limit exceeded
 
+    if candidates:
+        # one NMS call for the whole batch, boxes of every (image, class) group are shifted to their own region
+        img = torch.cat([torch.full((len(x),), xi, device=prediction.device) for xi, x in candidates])
+        x = torch.cat([x for _, x in candidates], 0)
+        group = img if agnostic else img * nc + x[:, 7].long()
+        span = x[:, :6].max() - x[:, :6].min() + 1  # groups are offset by more than the extent of all boxes
+        boxes, scores = x[:, :6] + (group[:, None] * span).to(x.dtype), x[:, 6]
+        i = _3d_nms(boxes, scores, iou_thres)  # 3D NMS, indices in decreasing order of scores
+
+        # limit detections per image, a stable sort by image keeps every image's detections sorted by confidence
+        i = i[img[i].argsort(stable=True)]
+        img_i = img[i]
+        rank = torch.arange(len(i), device=i.device) - torch.searchsorted(img_i, img_i)
+        i, img_i = i[rank < max_det], img_i[rank < max_det]
+        if merge:  # Merge NMS (boxes merged using weighted mean)
+            x[i, :6] = merge_boxes(x[:, :6], boxes, scores, i, iou_thres)
+
+        x = x[i]
+        for xi, _ in candidates:
+            output[xi] = x[img_i == xi]
+
     return output
+
+
+def merge_boxes(x, boxes, scores, i, iou_thres=0.45):
+    """Weighted-box merge for NMS, every kept box becomes the confidence weighted mean of all boxes
+    it overlaps with IoU > iou_thres, including itself.
+
+    Args:
+        x (torch.Tensor): (n,6) boxes to merge in zxyzxy format
+        boxes (torch.Tensor): (n,6) the same boxes offset by class, so boxes of different classes never overlap
+        scores (torch.Tensor): (n) confidence scores used as weights
+        i (torch.Tensor): indices of the boxes kept by NMS
+        iou_thres (float, optional): Minimum IOU for a box to be merged into a kept box. Defaults to 0.45.
+
+    Returns:
+        merged (torch.Tensor): (len(i),6) merged boxes in zxyzxy format
+    """
+    # update boxes as boxes(i,6) = weights(i,n) * boxes(n,6)
+    iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
+    iou[torch.arange(len(i), device=i.device), i] = True  # a kept box always contributes to itself
+    weights = iou * scores[None]  # box weights
+    return torch.mm(weights, x).float() / weights.sum(1, keepdim=True)
@@ -65,6 +65,83 @@ def weight_reduce_loss(loss, weight=None, reduction='mean', avg_factor=None):
     return loss
 
 
+def _varifocal_loss(x, t, alpha: float, gamma: float):
+    """Sum of the elementwise varifocal objectness loss of logits x and targets t."""
+    bce = x.clamp(min=0.) - x * t + torch.log1p(torch.exp(-x.abs()))  # binary_cross_entropy_with_logits
+    weight = torch.where(t > 0., t, alpha * (x.sigmoid() - t).abs().pow(gamma))
+    return (bce * weight).sum()
+
+
+def _varifocal_grad(x, t, alpha: float, gamma: float):
+    """Gradient of _varifocal_loss with respect to the logits x, the focal weight is differentiated as well."""
+    p = x.sigmoid()
+    bce = x.clamp(min=0.) - x * t + torch.log1p(torch.exp(-x.abs()))
+    diff = p - t
+    pos = t > 0.
+    weight = torch.where(pos, t, alpha * diff.abs().pow(gamma))
+    dweight = torch.where(pos, torch.zeros_like(x), alpha * gamma * diff.abs().pow(gamma - 1.) * diff.sign() * p * (1. - p))
+    return diff * weight + bce * dweight
+
+
+# fused elementwise kernels where TorchScript is available, eager otherwise
+try:
+    _varifocal_loss_fused = torch.jit.script(_varifocal_loss)
+    _varifocal_grad_fused = torch.jit.script(_varifocal_grad)
+except Exception:
+    _varifocal_loss_fused, _varifocal_grad_fused = _varifocal_loss, _varifocal_grad
+
+
+class VarifocalObjLoss(torch.autograd.Function):
+    """Mean varifocal objectness loss computed in chunks, so neither the forward nor the backward pass allocates
+    intermediates the size of the prediction grid.  The backward pass recomputes the gradient from the logits."""
+    chunk = 1 << 22  # elements per chunk
+
+    @staticmethod
+    def _chunks(x, t):
+        # rows of the (-1, h, w) views, the logits are usually a strided slice of the prediction grid
+        x, t = x.flatten(0, -3), t.flatten(0, -3)
+        step = max(1, VarifocalObjLoss.chunk // (x.shape[1] * x.shape[2]))
+        for r in range(0, x.shape[0], step):
+            yield x[r:r + step], t[r:r + step]
+
+    @staticmethod
+    def forward(ctx, x, t, alpha: float, gamma: float):
+        ctx.save_for_backward(x, t)
+        ctx.alpha, ctx.gamma = alpha, gamma
+        dtype = torch.promote_types(x.dtype, torch.float32)  # half precision logits are evaluated in float32
+        loss = torch.zeros((), dtype=dtype, device=x.device)
+        for xc, tc in VarifocalObjLoss._chunks(x, t):
+            loss += _varifocal_loss_fused(xc.to(dtype), tc.to(dtype), alpha, gamma)
+        return loss / x.numel()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, t = ctx.saved_tensors
+        grad = torch.empty(x.shape, dtype=x.dtype, device=x.device)
+        dtype = torch.promote_types(x.dtype, torch.float32)
+        scale = grad_output / x.numel()
+        for (xc, tc), (gc, _) in zip(VarifocalObjLoss._chunks(x, t), VarifocalObjLoss._chunks(grad, grad)):
+            gc.copy_(_varifocal_grad_fused(xc.to(dtype), tc.to(dtype), ctx.alpha, ctx.gamma) * scale)
+        return grad, None, None, None
+
+
+def varifocal_obj_loss(pred, tobj, alpha=0.75, gamma=1.5):
+    """Varifocal-style objectness loss averaged over the grid, the same value as
+    weight_reduce_loss(binary_cross_entropy_with_logits(pred, tobj, reduction='none') * focal_weight) with
+    focal_weight = tobj where tobj > 0 and alpha * |sigmoid(pred) - tobj| ** gamma elsewhere.
+
+    Args:
+        pred (torch.Tensor): objectness logits, at least 3 dimensions.
+        tobj (torch.Tensor): objectness targets, same shape as pred, not differentiated.
+        alpha (float, optional): weight of the negatives. Defaults to 0.75.
+        gamma (float, optional): focusing exponent of the negatives. Defaults to 1.5.
+
+    Returns:
+        loss (torch.Tensor): scalar loss.
+    """
+    return VarifocalObjLoss.apply(pred, tobj.detach(), alpha, gamma)
+
+
 def bbox_iov(box1, box2, eps=1E-7):
     """ Returns the intersection over box2 volume given box1, box2. Boxes are z1x1y1z2x2y2
     box1:       np.array of shape(6)
@@ -130,7 +207,7 @@ def bbox_iou(box1, box2, z1x1y1z2x2y2=True, eps=1e-7):
     return iou
 
 
-def box_iou(box1, box2):
+def box_iou(box1, box2, chunk=None):
     """Return intersection-over-union (Jaccard index) of boxes.
     Both sets of boxes are expected to be in (z1, x1, y1, z2, x2, y2) format.
     https://github.com/pytorch/vision/blob/master/torchvision/ops/boxes.py
@@ -138,10 +215,14 @@ def box_iou(box1, box2):
     Args:
         box1 (torch.Tensor): (Tensor[N, 6])
         box2 (torch.Tensor): (Tensor[M, 6])
+        chunk (int, optional): evaluate at most chunk boxes of box2 at a time, bounds the (N, chunk, 3) intermediates,
+            the result is identical. Defaults to None (all at once).
 
     Returns:
         iou (torch.Tensor): (Tensor[N, M]) the NxM matrix containing the pairwise IoU values for every element in boxes1 and boxes2
     """
+    if chunk is not None and box2.shape[0] > chunk:
+        return torch.cat([box_iou(box1, b) for b in box2.split(chunk)], 1)
 
     def box_volume(box):
         # box is nx6
@@ -225,6 +306,30 @@ class ComputeLossVF:
         self.nl = det.nl
         self.anchors = det.anchors
 
+        # target assignment buffers, reused between steps
+        # 3D offsets:
+        self.off = torch.tensor([[0, 0, 0],
+                                 [1, 0, 0], [0, 1, 0], [0, 0, 1], [-1, 0, 0], [0, -1, 0], [0, 0, -1], # i,j,k,l,m,n
+                                 ], device=device).float() * 0.5  # offsets
+        self.gains, self.gain_shapes = None, None
+
+    def target_gains(self, pred, device):
+        """Normalized to gridspace gains of all detection layers, kept until the prediction shapes change.
+
+        Args:
+            pred (List[torch.Tensor]): predictions of every detection layer
+            device (torch.device): device of the targets
+
+        Returns:
+            gains (torch.Tensor): (nl, 9) gains for image, class, zxydwh and anchor index
+        """
+        shapes = tuple(tuple(p.shape[2:5]) for p in pred)
+        if shapes != self.gain_shapes or self.gains.device != device:
+            self.gains = torch.ones(self.nl, 9, device=device)
+            self.gains[:, 2:8] = torch.tensor(shapes, device=device, dtype=torch.float32)[:, [0, 2, 1, 0, 2, 1]]  # zxyzxy gain
+            self.gain_shapes = shapes
+        return self.gains
+
     def __call__(self, p, targets):
         """Calculate losses
 
@@ -275,9 +380,7 @@ class ComputeLossVF:
             # using varifocal loss
             alpha = 0.75
             if self.g > 0:
-                focal_weight = tobj*(tobj > 0.0).float() + alpha*(pi[...,6].sigmoid() - tobj).abs().pow(self.g)*(tobj<=0.0).float()                
-                obji = torch.nn.functional.binary_cross_entropy_with_logits(pi[..., 6], tobj, reduction='none') * focal_weight
-                obji = weight_reduce_loss(obji)
+                obji = varifocal_obj_loss(pi[..., 6], tobj, alpha, self.g)  # chunked, no grid-sized intermediates
             # no varifocal/focal loss
             else:
                 obji = self.BCEobj(pi[..., 6], tobj)
@@ -310,58 +413,47 @@ class ComputeLossVF:
             indices (List[Tuple[float]]): image, anchor, and grid indices for each detection layer
             anch (List[int]): List of anchors corresponding to each detection layer
         """
-        # na, nt = self.na, targets.shape[0]  # number of anchors, targets
         tcls, tbox, indices, anch = [], [], [], []
-        gain = torch.ones(9, device=targets.device)  # normalized to gridspace gain
-        ai = torch.arange(self.na, device=targets.device).float().view(self.na, 1).repeat(1, targets.shape[0])  # same as .repeat_interleave(nt)
-        targets = torch.cat((targets.repeat(self.na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
-
+        na, nt = self.na, targets.shape[0]  # number of anchors, targets
+        gain = self.target_gains(pred, targets.device)  # (nl, 9) normalized to gridspace gains of all layers
         g = 0.5  # bias
-        # 3D offsets:
-        off = torch.tensor([[0, 0, 0],
-                            [1, 0, 0], [0, 1, 0], [0, 0, 1], [-1, 0, 0], [0, -1, 0], [0, 0, -1], # i,j,k,l,m,n
-                            ], device=targets.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            gain[2:8] = torch.tensor(pred[i].shape)[[2, 4, 3, 2, 4, 3]]  # zxyzxy gain
-
-            # Match target (normalized) size to anchors
-            t = targets * gain           
-            if targets.shape[0]:
-                # Matches
-                r = t[:, :, 5:8] / anchors[:, None]  # dwh ratio of anchors to targets
-                # compare - if any dimension of the anchor is off by more than a
-                # factor of anchor_t from the target, filter that anchor out
-                j = torch.max(r, 1. / r).max(2)[0] < self.hyp['anchor_t']
-                t = t[j]  # filter
-
-                # Offsets
-                gzxy = t[:, 2:5]  # grid zxy
-                gzi = gain[[2, 3, 4]] - gzxy  # inverse
-                i, j, k = ((gzxy % 1. < g) & (gzxy > 1.)).T
-                l, m, n = ((gzi % 1. < g) & (gzi > 1.)).T
-                i = torch.stack((torch.ones_like(i), i, j, k, l, m, n))
-                t = t.repeat((7, 1, 1))[i]
-                offsets = (torch.zeros_like(gzxy)[None] + off[:, None])[i]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gzxy = t[:, 2:5]  # grid zxy
-            gdwh = t[:, 5:8]  # grid dwh
-            gijk = (gzxy - offsets).long()
-            gi, gj, gk = gijk.T  # grid xyz indices
-
-            # Append
-            a = t[:, 8].long()  # anchor indices
-            gain = gain.to(torch.long)            
-            indices.append((b, a, gi.clamp_(0, gain[2] - 1), gk.clamp_(0, gain[4] - 1), gj.clamp_(0, gain[3] - 1)))  # image, anchor, grid indices
-            tbox.append(torch.cat((gzxy - gijk, gdwh), 1))  # box
-            anch.append(anchors[a])  # anchors
-            tcls.append(c)  # class
+
+        # targets of every layer and anchor in grid units, (nl, na, nt, 9) with the anchor index appended
+        ai = torch.arange(na, device=targets.device).float()[:, None, None].expand(na, nt, 1)
+        t = torch.cat((targets.expand(na, nt, 8), ai), 2)[None] * gain[:, None, None]
+
+        # Matches
+        r = t[..., 5:8] / self.anchors[:, :, None]  # dwh ratio of anchors to targets
+        # compare - if any dimension of the anchor is off by more than a
+        # factor of anchor_t from the target, filter that anchor out
+        j = torch.max(r, 1. / r).max(3)[0] < self.hyp['anchor_t']
+
+        # Offsets, the target itself and the neighbour cells i,j,k,l,m,n its center is close to
+        gzxy = t[..., 2:5]  # grid zxy
+        gzi = gain[:, None, None, 2:5] - gzxy  # inverse
+        near = torch.cat((torch.ones_like(j[..., None]), (gzxy % 1. < g) & (gzxy > 1.), (gzi % 1. < g) & (gzi > 1.)), 3)
+        near = (near & j[..., None]).permute(0, 3, 1, 2)  # (nl, 7, na, nt), same order as the per-layer expansion
+        t = t[:, None].expand(-1, 7, -1, -1, -1)[near]
+        offsets = self.off[None, :, None, None].expand(self.nl, -1, na, nt, -1)[near]
+        n = near.flatten(1).sum(1)  # targets per layer
+        layer = torch.repeat_interleave(torch.arange(self.nl, device=targets.device), n)
+
+        # Define
+        b, c = t[:, :2].long().T  # image, class
+        gzxy = t[:, 2:5]  # grid zxy
+        gdwh = t[:, 5:8]  # grid dwh
+        a = t[:, 8].long()  # anchor indices
+        gijk = torch.min((gzxy - offsets).long().clamp_(min=0), gain[layer, 2:5].long() - 1)  # grid zxy indices
+
+        # Append, split by layer
+        n = n.tolist()
+        box = torch.cat((gzxy - gijk, gdwh), 1)
+        for bl, al, cl, gl, boxl, anchl in zip(b.split(n), a.split(n), c.split(n), gijk.split(n), box.split(n),
+                                               self.anchors[layer, a].split(n)):
+            indices.append((bl, al, gl[:, 0], gl[:, 2], gl[:, 1]))  # image, anchor, grid indices
+            tbox.append(boxl)  # box
+            anch.append(anchl)  # anchors
+            tcls.append(cl)  # class
 
         return tcls, tbox, indices, anch
 
@@ -396,7 +488,7 @@ class ConfusionMatrix:
         detections = detections[detections[:, 6] > self.conf]
         gt_classes = labels[:, 0].int()
         detection_classes = detections[:, 7].int()
-        iou = box_iou(labels[:, 1:], detections[:, :6])
+        iou = box_iou(labels[:, 1:], detections[:, :6], chunk=4096)
 
         x = torch.where(iou > self.iou_thres)
         if x[0].shape[0]:
@@ -0,0 +1,80 @@
+"""
+Sliding-window inference for YOLO3D.  Runs the model on overlapping windows of a volume at a target spacing
+instead of resampling the whole scan to a single cube, so memory stays bounded and small structures keep their resolution.
+"""
+
+# standard library imports
+import itertools
+import torch
+
+# 3D YOLO imports
+from utils3D.datasets import change_nifti_size
+
+
+def window_starts(size: int, window: int, overlap: float):
+    """Start indices of windows of length window covering an axis of length size.
+    The last window is aligned to the end of the axis, a single window is used if the axis is shorter than it.
+
+    Args:
+        size (int): length of the axis in voxels
+        window (int): window length in voxels
+        overlap (float): fraction of the window shared by neighbouring windows, in [0, 1)
+
+    Returns:
+        starts (List[int]): start index of every window
+    """
+    if size <= window:
+        return [0]
+    step = max(1, int(window * (1 - overlap)))
+    return list(range(0, size - window, step)) + [size - window]
+
+
+def sliding_window_predict(model, volume: torch.Tensor, spacing, imgsz: int, target_spacing=None, overlap=0.25,
+                           batch_size=1, preprocess=None):
+    """Runs the model on overlapping windows of a volume and maps all window predictions back to the volume.
+
+    Each window covers imgsz * target_spacing mm per axis and is resized to the imgsz cube the model expects.
+    Windows that extend past the volume are padded with the volume minimum.  The returned predictions of all
+    windows are in voxel coordinates of the volume and can be merged with non_max_suppression.
+
+    Args:
+        model (torch.nn.Module): YOLO3D model
+        volume (torch.Tensor): (depth, height, width) volume at native resolution, any dtype
+        spacing (Tuple[float]): voxel size of volume in mm, (depth, height, width) order
+        imgsz (int): edge length of the model input cube
+        target_spacing (Tuple[float], optional): voxel size in mm the model sees, (depth, height, width) order.
+            Defaults to None (native spacing).
+        overlap (float, optional): fraction of overlap between neighbouring windows. Defaults to 0.25.
+        batch_size (int, optional): number of windows per forward pass. Defaults to 1.
+        preprocess (callable, optional): applied to every batch of windows before the forward pass,
+            e.g. device transfer and normalization. Defaults to None.
+
+    Returns:
+        pred (torch.Tensor): (1, n, 7 + nc) predictions in [z, x, y, d, w, h, obj, cls...] format, volume voxel units
+    """
+    target_spacing = spacing if target_spacing is None else target_spacing
+    window = [max(1, round(imgsz * t / s)) for t, s in zip(target_spacing, spacing)]  # window edge in voxels, d h w
+    corners = list(itertools.product(*(window_starts(n, w, overlap) for n, w in zip(volume.shape, window))))
+    pad_value = float(volume.min())
+
+    preds = []
+    for b in range(0, len(corners), batch_size):
+        tiles = []
+        for z, y, x in corners[b:b + batch_size]:
+            tile = volume[z:z + window[0], y:y + window[1], x:x + window[2]].float()
+            pad = [0, window[2] - tile.shape[2], 0, window[1] - tile.shape[1], 0, window[0] - tile.shape[0]]
+            if any(pad):
+                tile = torch.nn.functional.pad(tile[None, None], pad, value=pad_value)[0, 0]
+            tiles.append(change_nifti_size(tile, imgsz))
+        tiles = torch.stack(tiles, 0)
+        if preprocess is not None:
+            tiles = preprocess(tiles)
+
+        pred = model(tiles)[0].float()  # zxydwh in window pixels, x along width and y along height
+        gain = torch.tensor([window[0], window[2], window[1]], device=pred.device) / imgsz  # z, x, y
+        offset = torch.tensor([[z, x, y] for z, y, x in corners[b:b + batch_size]], device=pred.device)
+        pred[..., 0:3] = pred[..., 0:3] * gain + offset[:, None, :]
+        pred[..., 3:6] *= gain
+        preds.append(pred.reshape(-1, pred.shape[-1]))
+
+    return torch.cat(preds, 0)[None]
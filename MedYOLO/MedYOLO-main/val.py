@@ -28,7 +28,7 @@ from utils.callbacks import Callbacks
 
 # 3D YOLO imports
 from utils3D.datasets import nifti_dataloader
-from utils3D.general import zxyzxy2zxydwh, non_max_suppression, zxydwh2zxyzxy, scale_coords
+from utils3D.general import zxyzxy2zxydwh, non_max_suppression, zxydwh2zxyzxy, scale_coords, label_rows, write_label_rows
 from utils3D.lossandmetrics import ConfusionMatrix, box_iou
 from models3D.model import attempt_load
 
@@ -43,29 +43,33 @@ def save_one_txt(predn, save_conf, shape, file):
     # 3D:
     gn = torch.tensor(shape)[[0, 2, 1, 0, 2, 1]]  # normalization gain dwhdwh
 
-    for *zxyzxy, conf, cls in predn.tolist():
-        zxydwh = (zxyzxy2zxydwh(torch.tensor(zxyzxy).view(1, 6)) / gn).view(-1).tolist()  # normalized zxydwh
-        line = (cls, *zxydwh, conf) if save_conf else (cls, *zxydwh)  # label format
-        with open(file, 'a') as f:
-            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+    rows = label_rows(predn, gn)  # cls, normalized zxydwh, conf
+    write_label_rows(file, rows if save_conf else rows[:, :7])
 
 
-def process_batch(detections, labels, iouv):
+def process_batch(detections, labels, iouv, chunk=4096):
     """
     Return correct predictions matrix. Both sets of boxes are in (z1, x1, y1, z2, x2, y2) format.
     Arguments:
         detections (Array[N, 8]), z1, x1, y1, z2, x2, y2, conf, class
         labels (Array[M, 7]), class, z1, x1, y1, z2, x2, y2
+        chunk (int), detections matched at a time, bounds memory without changing the matches
     Returns:
         correct (Array[N, 10]), for 10 IoU levels
     """
     # main changes from 2D are adding the 2 extra entries for z positions
     correct = torch.zeros(detections.shape[0], iouv.shape[0], dtype=torch.bool, device=iouv.device)
-    iou = box_iou(labels[:, 1:], detections[:, :6])
-    x = torch.where((iou >= iouv[0]) & (labels[:, 0:1] == detections[:, 7]))  # IoU above threshold and classes match
-    if x[0].shape[0]:
-        matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detection, iou]
-        if x[0].shape[0] > 1:
+    matches = []  # [label, detection, iou] above the lowest threshold, collected per chunk of detections
+    for d0 in range(0, detections.shape[0], chunk):
+        det = detections[d0:d0 + chunk]
+        iou = box_iou(labels[:, 1:], det[:, :6])
+        x = torch.where((iou >= iouv[0]) & (labels[:, 0:1] == det[:, 7]))  # IoU above threshold and classes match
+        if x[0].shape[0]:
+            matches.append(torch.cat((torch.stack((x[0], x[1] + d0), 1), iou[x[0], x[1]][:, None]), 1))
+    if matches:
+        matches = torch.cat(matches, 0).cpu().numpy()  # [label, detection, iou]
+        matches = matches[np.lexsort((matches[:, 1], matches[:, 0]))]  # label-major, as from one IoU matrix
+        if matches.shape[0] > 1:
             matches = matches[matches[:, 2].argsort()[::-1]]
             matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
             matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
@@ -183,7 +187,9 @@ def run(data,
         targets[:, 2:] *= torch.Tensor([depth, width, height, depth, width, height]).to(device)  # to pixels
         lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
         t3 = time_sync()
-        out = non_max_suppression(out, conf_thres, iou_thres, labels=lb, multi_label=True, agnostic=single_cls)
+        # one NMS call for the whole batch on GPU, on CPU the per-image calls avoid comparing boxes across images
+        out = non_max_suppression(out, conf_thres, iou_thres, labels=lb, multi_label=True, agnostic=single_cls,
+                                  batched=device.type != 'cpu')
         dt[2] += time_sync() - t3
 
         # Statistics per image
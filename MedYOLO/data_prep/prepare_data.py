@@ -193,8 +193,47 @@ def convert_json_to_medyolo(nifti_folder, json_folder, output_folder):
 import os
 import shutil
 import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-def copy_no_pfo_nifti(xlsx_path, nifti_folder, output_folder, column_name, sheet_name=0):
+FICLONE = 0x40049409  # Linux ioctl that shares the data blocks of two files (btrfs, XFS)
+
+def transfer_file(src, dst, mode="copy"):
+    """
+    Places src at dst by copying, hard-linking or reflinking it.
+
+    "hardlink" and "reflink" fall back to shutil.copy2 when the link cannot be made,
+    e.g. across filesystems or on filesystems without reflink support.
+
+    Args:
+        src (str): Source file.
+        dst (str): Destination file, replaced if it exists.
+        mode (str): "copy", "hardlink" or "reflink".
+    """
+    if mode not in ("copy", "hardlink", "reflink"):
+        raise ValueError(f"Unknown transfer mode: {mode}")
+    if mode != "copy":
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+        try:
+            if mode == "hardlink":
+                os.link(src, dst)
+            else:
+                import fcntl
+                with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+            return
+        except (OSError, ImportError):
+            try:
+                os.remove(dst)
+            except FileNotFoundError:
+                pass
+    shutil.copy2(src, dst)
+
+def copy_no_pfo_nifti(xlsx_path, nifti_folder, output_folder, column_name, sheet_name=0, num_workers=8, mode="copy"):
     """
     Copies NIfTI files where the selected column contains 'No' to a new folder.
     Handles NIfTI filenames with variable suffixes (e.g., 65, 70, 75).
@@ -205,6 +244,8 @@ def copy_no_pfo_nifti(xlsx_path, nifti_folder, output_folder, column_name, sheet
         output_folder (str): Destination folder for "No PFO" cases.
         column_name (str): Name of the column to check for 'No'.
         sheet_name (int or str): Sheet name or index (default is 0, the first sheet).
+        num_workers (int): Number of threads doing the copies.
+        mode (str): "copy", "hardlink" or "reflink", see transfer_file.
     """
 
     # Create output folder if it doesn't exist
@@ -217,22 +258,34 @@ def copy_no_pfo_nifti(xlsx_path, nifti_folder, output_folder, column_name, sheet
     # Filter patients with "No" in the specified column (case-insensitive)
     no_pfo_patients = df[df[column_name].astype(str).str.lower() == "no"]
 
-    for index, row in no_pfo_patients.iterrows():
-        patient_id = str(row["Imaging pseudo ID"]).strip()  
-
-        # Find all possible NIfTI files for this patient (any suffix number)
-        possible_files = [f for f in os.listdir(nifti_folder) if f.startswith(f"{patient_id}_") and f.endswith(".nii.gz")]
-        missing_files = []
+    # Scan the NIfTI folder once and index every file under each prefix that ends before an "_",
+    # so a lookup returns exactly the files starting with f"{patient_id}_" (e.g. <id>_<a>_<b>.nii.gz)
+    nifti_by_patient = defaultdict(list)
+    for nifti_filename in sorted(os.listdir(nifti_folder)):
+        if nifti_filename.endswith(".nii.gz"):
+            stem = nifti_filename[:-len(".nii.gz")]
+            pos = stem.find("_")
+            while pos != -1:
+                nifti_by_patient[stem[:pos]].append(nifti_filename)
+                pos = stem.find("_", pos + 1)
+
+    missing_files = []
+    to_copy = []
+    for patient_id in no_pfo_patients["Imaging pseudo ID"].astype(str).str.strip():
+        possible_files = nifti_by_patient.get(patient_id, [])
         if not possible_files:
             print(f"❌ No matching NIfTI files found for patient {patient_id}, skipping...")
             missing_files.append(patient_id)
             continue
+        to_copy.extend(possible_files)
+    to_copy = list(dict.fromkeys(to_copy))  # repeated or "_"-prefixed ids match the same file, copy it once
 
-        for nifti_filename in possible_files:
-            nifti_path = os.path.join(nifti_folder, nifti_filename)
-            new_path = os.path.join(output_folder, nifti_filename)
+    def copy_one(nifti_filename):
+        transfer_file(os.path.join(nifti_folder, nifti_filename), os.path.join(output_folder, nifti_filename), mode)
+        return nifti_filename
 
-            shutil.copy2(nifti_path, new_path)  # Copy instead of move
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for nifti_filename in executor.map(copy_one, to_copy):
             print(f"✅ Copied: {nifti_filename} → {output_folder}")
     print(missing_files)
 
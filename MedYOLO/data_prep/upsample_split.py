@@ -9,7 +9,20 @@ def prepare_medyolo_split(
         n_val_pfo=4,           # keep these original PFOs for val
         n_train_neg=80,        # negatives kept for train
         n_val_neg=80,          # negatives kept for val  (reflecting prevalence)
-        seed=42):
+        seed=42,
+        dup_mode='copy'):      # 'copy', 'hardlink', 'symlink' or 'manifest' (see below)
+    """
+    Builds a MedYOLO train/val split in which the train PFOs are oversampled n_train_dup times.
+
+    dup_mode decides how the oversampling is stored:
+        'copy'     : every duplicate is a full copy of the volume (original behaviour)
+        'hardlink' : duplicates are hard links, 'symlink' : duplicates are symbolic links,
+                     both fall back to a copy when the link cannot be made (e.g. across filesystems)
+        'manifest' : every case is written once and the duplication is stored as sampling weights in
+                     out_dir/train_weights.txt, referenced by data.yaml as 'train_weights'.
+                     nifti_dataloader then draws the train cases with a WeightedRandomSampler.
+    """
+    assert dup_mode in ('copy', 'hardlink', 'symlink', 'manifest'), f"unknown dup_mode {dup_mode}"
 
     random.seed(seed)
     out_dir = Path(out_dir)
@@ -24,15 +37,29 @@ def prepare_medyolo_split(
     val_pfo = random.sample(pfo_files, n_val_pfo)
     train_pfo = [f for f in pfo_files if f not in val_pfo]
 
-    # duplicate train PFOs k‑times
-    train_pfo_dup = train_pfo * n_train_dup
+    # duplicate train PFOs k‑times (as sampling weights in manifest mode)
+    train_pfo_dup = train_pfo if dup_mode == 'manifest' else train_pfo * n_train_dup
 
     # ---------- sample negatives ----------
     random.shuffle(neg_files)
     train_neg = neg_files[:n_train_neg]
     val_neg   = neg_files[n_train_neg:n_train_neg+n_val_neg]
 
-    # ---------- helper -----------
+    # ---------- helpers -----------
+    def place_file(src, dst):
+        if dst.is_symlink() or dst.exists():
+            dst.unlink()
+        try:
+            if dup_mode == 'hardlink':
+                os.link(src, dst)
+                return
+            if dup_mode == 'symlink':
+                os.symlink(Path(src).resolve(), dst)
+                return
+        except OSError:
+            pass                                          # e.g. cross‑device link, fall back to a copy
+        shutil.copy2(src, dst)
+
     def copy_set(file_list, split, label_dir, img_dir, make_unique=True):
         for idx, stem in enumerate(file_list):
             if make_unique:
@@ -47,8 +74,8 @@ def prepare_medyolo_split(
             dst_lbl = out_dir/'labels'/split/dst_stem.replace('.nii.gz','.txt')
             dst_img.parent.mkdir(parents=True, exist_ok=True)
             dst_lbl.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src_img, dst_img)                        # or os.link for hard‑link
-            shutil.copy2(src_lbl, dst_lbl)
+            place_file(src_img, dst_img)
+            place_file(src_lbl, dst_lbl)
 
  # ---------- copy files ----------
     copy_set(train_pfo_dup, 'train', pfo_lbl_dir, pfo_img_dir)
@@ -56,7 +83,17 @@ def prepare_medyolo_split(
     copy_set(val_pfo,       'val',   pfo_lbl_dir, pfo_img_dir)
     copy_set(val_neg,       'val',   neg_lbl_dir, neg_img_dir)
 
-    print(f"Train  : {len(train_pfo_dup)} PFO  + {len(train_neg)} No‑PFO")
+    if dup_mode == 'manifest':
+        # one line per train case: file name and how often it is drawn per epoch
+        weights_path = out_dir/'train_weights.txt'
+        with open(weights_path, 'w') as f:
+            for idx, stem in enumerate(train_pfo):
+                f.write(f"{stem.replace('.nii.gz', f'_dup{idx}.nii.gz')} {n_train_dup}\n")
+            for idx, stem in enumerate(train_neg):
+                f.write(f"{stem.replace('.nii.gz', f'_dup{idx}.nii.gz')} 1\n")
+        print(f"Train  : {len(train_pfo)} PFO (weight {n_train_dup}) + {len(train_neg)} No‑PFO, weights in {weights_path}")
+    else:
+        print(f"Train  : {len(train_pfo_dup)} PFO  + {len(train_neg)} No‑PFO")
     print(f"Val    : {len(val_pfo)} PFO  + {len(val_neg)} No‑PFO")
     print("✅ dataset written to", out_dir)
     # ---------- write YAML ----------
@@ -66,6 +103,8 @@ def prepare_medyolo_split(
         'nc'   : 2,
         'names': ['no_pfo', 'pfo']
     }
+    if dup_mode == 'manifest':
+        data['train_weights'] = str(out_dir/'train_weights.txt')
     yaml_path = out_dir/'data.yaml'
     with open(yaml_path,'w') as f: yaml.safe_dump(data, f, sort_keys=False)
     print('data yaml saved to ', yaml_path)